@@ -1,50 +1,216 @@
 import os
 import logging
-from typing import List, Optional, Dict, Set, Tuple, Any
-from dataclasses import dataclass
+from typing import List, Optional, Dict, Set, Tuple, Any, Union
+from dataclasses import dataclass, replace
 import ebooklib
 from ebooklib import epub
-from bs4 import BeautifulSoup, Tag # Keep Tag import
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer, Tag # Keep Tag import
 from PIL import Image
-from io import BytesIO
-import base64
+from io import BytesIO, StringIO
+import binascii
+import re
+import sys
+import warnings
+import functools
 import urllib.parse
+import posixpath
 import hashlib
 from pathlib import Path
-import xml.etree.ElementTree as ET
-from xml.dom import minidom # For pretty printing XML
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from xml.sax.saxutils import escape, quoteattr
+try:
+    import xxhash # Optional: non-cryptographic image fingerprints, several times faster than BLAKE2b
+except ImportError:
+    xxhash = None
+try:
+    import lxml # BeautifulSoup's 'lxml' parser backend
+except ImportError:
+    lxml = None
+try:
+    from bs4 import XMLParsedAsHTMLWarning
+except ImportError: # bs4 < 4.11
+    XMLParsedAsHTMLWarning = None
+if XMLParsedAsHTMLWarning is not None:
+    # Spine documents are XHTML read with the HTML parser (ExtractorConfig.parser) on purpose; without this,
+    # bs4 warns once per document. Set at import time so spawned parser workers get the filter too.
+    warnings.filterwarnings('ignore', category=XMLParsedAsHTMLWarning)
+
+# Data-URIs larger than this are decoded directly instead of being kept in the cache. The cache holds
+# each payload string plus its decoded bytes, so this bounds it to about 256 * 28 KB; repeated icons are far smaller
+DATA_URI_CACHE_MAX_LEN = 16 * 1024
+
+@functools.lru_cache(maxsize=256)
+def _decode_data_uri_cached(encoded: str) -> bytes:
+    return binascii.a2b_base64(encoded)
+
+def decode_data_uri(encoded: str) -> bytes:
+    """Decode the base64 payload of a data-URI, memoizing small repeated payloads (icons etc.).
+    a2b_base64 reads an ASCII str in C directly, so the payload is never re-encoded to bytes first."""
+    if len(encoded) > DATA_URI_CACHE_MAX_LEN:
+        return binascii.a2b_base64(encoded)
+    return _decode_data_uri_cached(encoded)
+
+# Block-level elements that enforce paragraph breaks
+_BLOCK_TAGS = frozenset({'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'div', 'section',
+                         'article', 'main', 'figure', 'figcaption', 'blockquote', 'pre',
+                         'ul', 'ol', 'li', 'dl', 'dt', 'dd', 'table', 'hr', 'header', 'footer', 'aside'})
+# Headings keep their tag name as the paragraph role
+_HEADING_TAGS = frozenset({'h1', 'h2', 'h3', 'h4', 'h5', 'h6'})
+_IMAGE_TAGS = frozenset({'img', 'image'})
+# Layout wrappers that are flattened when they only hold block content
+_CONTAINER_TAGS = frozenset({'div', 'section', 'article'})
+
+# Only <body> is walked; <head> (title, stylesheets, scripts, meta) is skipped while parsing
+_BODY_STRAINER = SoupStrainer('body')
+
+# Whitespace runs collapsed to a single space in paragraph text (same characters as str.split())
+_WS_RE = re.compile(r'\s+')
+
+# Characters that need escaping in XML text; most paragraphs contain none and are written as-is
+_ESCAPE_RE = re.compile(r'[<>&]')
+
+# Leading '/', './' and '../' segments; unlike lstrip('./') this never eats the dot of a '.hidden' name
+_PREFIX_RE = re.compile(r'^(?:\.{0,2}/)+')
+
+@functools.lru_cache(maxsize=4096)
+def _normalize_href(raw: str) -> str:
+    """Normalize an EPUB item href (unquoted, no fragment, forward slashes, no leading /, ./ or ../)"""
+    href = urllib.parse.unquote(raw).split('#', 1)[0].replace('\\', '/')
+    if not href:
+        return href
+    return _PREFIX_RE.sub('', posixpath.normpath(href))
+
+IMAGE_LOG_ENTRY_TEMPLATE = ("File:       %s\n"
+                            "Saved Path: %s\n"
+                            "Dimensions: %s\n"
+                            "Source Ctx: %s\n"
+                            "Hash:       %s\n" + "-" * 60 + "\n")
+
+def _is_svg(data: bytes) -> bool:
+    """Sniff an SVG document (optionally behind a BOM, XML declaration or doctype) from its first bytes"""
+    head = data[:1024].lstrip(b'\xef\xbb\xbf \t\r\n')
+    return head.startswith(b'<svg') or (head.startswith((b'<?xml', b'<!DOCTYPE', b'<!--')) and b'<svg' in head)
+
+def _is_layout_only(tag: Tag) -> bool:
+    """True if the container holds no inline text or inline tags of its own"""
+    for child in tag.children:
+        if isinstance(child, Tag):
+            if child.name not in _BLOCK_TAGS and child.name not in _IMAGE_TAGS and child.name != 'svg':
+                return False
+        elif child.strip():
+            return False
+    return True
+
+def _walk(el: Tag):
+    """Yield the content tags under `el`, descending into layout-only containers instead of yielding them"""
+    for child in el.children:
+        if not isinstance(child, Tag):
+            continue
+        if child.name in _CONTAINER_TAGS and _is_layout_only(child):
+            yield from _walk(child)
+        else:
+            yield child
 
 @dataclass
 class ExtractorConfig:
     """Configuration settings for the EPUB processor"""
     min_image_width: int = 128
     min_image_height: int = 128
+    max_image_width: Optional[int] = 2048 # Larger images are scaled down to fit; None keeps the original size
+    max_image_height: Optional[int] = 2048
     image_format: str = 'JPEG'
     quality: int = 95
+    jpeg_passthrough: bool = True # Copy RGB/grayscale JPEGs that need no resize as-is instead of re-encoding at `quality`
     output_encoding: str = 'utf-8'
-    parser: str = 'html.parser'
+    parser: str = 'lxml'
     output_dir: str = 'output'
     image_dir: str = 'images'
     xml_filename: str = 'content.xml'
+    mark_duplicates: bool = True # Emit repeated paragraphs as translate="no" duplicate_of="pN"
+    duplicate_min_length: int = 30 # Shorter repeats (interjections, "……") are still translated in context
+    max_workers: Optional[int] = None # Parser processes for spine documents; None = min(8, cpu count), 1 = in-process
+    image_encode_workers: int = 4 # Background threads converting/encoding images; 0 = encode inline
+    log_level: str = 'INFO' # 'DEBUG' traces every tag, paragraph and image lookup (slow on large books)
+    include_metadata: bool = False # Read and log the Dublin Core metadata; it is never written to the XML
+
+@dataclass
+class DocumentContext:
+    """Per-document values shared by every tag processed in that document"""
+    base_href: str # Unquoted href of the document inside the EPUB
+    base_dir: str # Directory part of base_href ('' for documents at the EPUB root)
+
+    @classmethod
+    def from_href(cls, base_href: str) -> 'DocumentContext':
+        return cls(base_href=base_href, base_dir=posixpath.dirname(base_href))
+
+# Structured items passed from ContentProcessor to XMLContentWriter. Slotted classes are a fraction
+# of the size of per-item dicts and are what parser workers pickle back to the main process.
+@dataclass(slots=True)
+class Paragraph:
+    """A paragraph of collapsed text"""
+    text: str
+    role: Optional[str] = None # h1-h6 for paragraphs that come from headings
+
+@dataclass(slots=True)
+class ImageRef:
+    """An image tag found while parsing, not yet extracted from the EPUB or saved"""
+    src: str
+    width: Optional[int]
+    height: Optional[int]
+    context: str
+    tag_name: str
+
+@dataclass(slots=True)
+class ImageItem:
+    """A saved image, ready to be written to the XML"""
+    filename: str
+    alt: str
+
+ContentItem = Union[Paragraph, ImageRef, ImageItem]
+
+# Attribute names probed, in order, for an image's source and size (HTML, SVG/XLink, lazy-loading variants)
+_SRC_KEYS = ('src', 'xlink:href', '{http://www.w3.org/1999/xlink}href', 'href', 'data-src')
+_WIDTH_KEYS = ('width', 'data-width', '{http://www.w3.org/1999/xlink}width')
+_HEIGHT_KEYS = ('height', 'data-height', '{http://www.w3.org/1999/xlink}height')
+
+def _first_attr(attrs: Dict[str, Any], keys: Tuple[str, ...]) -> Optional[Any]:
+    """First non-empty value among keys in a tag's attrs dict"""
+    for key in keys:
+        value = attrs.get(key)
+        if value:
+            return value
+    return None
 
 class ImageProcessor:
     """Handles all image-related operations including SVG"""
 
-    def __init__(self, image_dir: Path, logger: logging.Logger):
+    def __init__(self, image_dir: Optional[Path], logger: logging.Logger):
+        # None for parser workers, which only read image tags and never save anything
         self.image_dir = image_dir
+        if image_dir is not None:
+            self.image_dir.mkdir(parents=True, exist_ok=True)
         self.logger = logger
-        self.processed_images: Set[str] = set()
-        self.image_log: List[Dict] = []
+        # Image hash -> log entry of the saved image; doubles as the dedup index
+        self.image_log_by_hash: Dict[bytes, Dict] = {}
+        # Names of the files already in image_dir, listed once on first use instead of a stat per image
+        self._names_on_disk: Optional[Set[str]] = None
+        # Background encoder; PIL releases the GIL while converting and encoding, so this overlaps with parsing
+        self._encoder: Optional[ThreadPoolExecutor] = None
+        self._pending_writes: List[Future] = []
+        # Files whose background write failed after the XML already referenced them; returned by close()
+        self.failed_writes: List[str] = []
+
+    @property
+    def image_log(self) -> List[Dict]:
+        """Log entries of the saved images, in the order they were first saved"""
+        return list(self.image_log_by_hash.values())
 
     def get_dimensions(self, tag: Tag) -> Tuple[Optional[int], Optional[int]]:
         """Extract image dimensions from tag attributes including SVG"""
         try:
-            width = (tag.get('width') or
-                    tag.get('data-width') or
-                    tag.get('{http://www.w3.org/1999/xlink}width'))
-            height = (tag.get('height') or
-                     tag.get('data-height') or
-                     tag.get('{http://www.w3.org/1999/xlink}height'))
+            attrs = tag.attrs
+            width = _first_attr(attrs, _WIDTH_KEYS)
+            height = _first_attr(attrs, _HEIGHT_KEYS)
 
             width_val = None
             height_val = None
@@ -66,29 +232,30 @@ class ImageProcessor:
 
     def get_source(self, tag: Tag) -> Optional[str]:
         """Extract image source from various attribute formats including SVG"""
-        return (tag.get('src') or
-                tag.get('xlink:href') or
-                tag.get('{http://www.w3.org/1999/xlink}href') or
-                tag.get('href') or
-                tag.get('data-src'))
+        return _first_attr(tag.attrs, _SRC_KEYS)
 
-    def compute_hash(self, data: bytes) -> str:
-        """Generate unique hash for image data"""
-        return hashlib.md5(data).hexdigest()
+    def compute_hash(self, data: bytes) -> bytes:
+        """Generate unique hash for image data (raw digest, hex-encoded only for names and logs).
+        Uses XXH3-128 when xxhash is installed, a BLAKE2b digest of the same 16-byte size otherwise."""
+        if xxhash is not None:
+            return xxhash.xxh3_128_digest(data)
+        return hashlib.blake2b(data, digest_size=16).digest()
 
     def save(self, image_data: bytes, source_info: str = "",
              width: Optional[int] = None, height: Optional[int] = None,
-             config: ExtractorConfig = None) -> Optional[Dict[str, Any]]:
-        """Save image with deduplication. Returns dict with path and dimensions if saved."""
+             config: ExtractorConfig = None,
+             precomputed_hash: Optional[bytes] = None) -> Optional[Dict[str, Any]]:
+        """Save image with deduplication. Returns dict with path and dimensions if saved.
+        Pass precomputed_hash when the caller already hashed image_data to skip hashing it again."""
         if not config:
              self.logger.error("ImageProcessor.save called without config!")
              return None
         try:
-            image_hash = self.compute_hash(image_data)
+            image_hash = precomputed_hash or self.compute_hash(image_data)
 
-            existing_log = next((log for log in self.image_log if log['hash'] == image_hash), None)
+            existing_log = self.image_log_by_hash.get(image_hash)
             if existing_log:
-                 self.logger.debug(f"Image hash {image_hash} already processed. Reusing path: {existing_log['filepath']}")
+                 self.logger.debug("Image hash %s already processed. Reusing path: %s", image_hash.hex(), existing_log["filepath"])
                  return {
                      'filepath': existing_log['filepath'],
                      'filename': existing_log['filename'],
@@ -97,96 +264,395 @@ class ImageProcessor:
                      'source': source_info
                  }
 
-            with Image.open(BytesIO(image_data)) as img:
-                actual_width = width if width is not None else img.width
-                actual_height = height if height is not None else img.height
+            # Tag attributes take precedence over the real size, so they alone can reject the image before PIL runs
+            if ((width is not None and width < config.min_image_width) or
+                (height is not None and height < config.min_image_height)):
+                self.logger.info(f"Skipping image {source_info} due to tag dimensions {width}x{height} < minimum {config.min_image_width}x{config.min_image_height}")
+                return None
 
-                if (actual_width < config.min_image_width or
-                    actual_height < config.min_image_height):
-                    self.logger.info(f"Skipping image {source_info} due to dimensions {actual_width}x{actual_height} < minimum {config.min_image_width}x{config.min_image_height}")
-                    return None
+            if _is_svg(image_data):
+                # Vector images can't go through Pillow; keep the original file
+                return self._save_svg(image_data, image_hash, source_info, width, height)
 
-                img_extension = config.image_format.lower() if config.image_format != 'JPEG' else 'jpg'
-                filename = f"{image_hash}_{actual_width}x{actual_height}.{img_extension}"
-                filepath = self.image_dir / filename
-
-                if filepath.exists():
-                     self.logger.debug(f"Image file already exists: {filepath}. Skipping save operation.")
-                     if image_hash not in self.processed_images:
-                         pass
-                     else:
-                         return {
-                            'filepath': str(filepath),
-                            'filename': filename,
-                            'dimensions': f"{actual_width}x{actual_height}",
-                            'hash': image_hash,
-                            'source': source_info
-                        }
-                else:
-                    self.image_dir.mkdir(parents=True, exist_ok=True)
-                    if img.mode in ('RGBA', 'LA', 'P'):
-                        img = img.convert('RGBA')
-                        background = Image.new('RGB', img.size, 'white')
-                        background.paste(img, mask=img.split()[-1])
-                        background.save(filepath, config.image_format, quality=config.quality)
-                    elif img.mode == 'CMYK':
-                         img = img.convert('RGB')
-                         img.save(filepath, config.image_format, quality=config.quality)
-                    else:
-                        img.convert('RGB').save(filepath, config.image_format, quality=config.quality)
-                    self.logger.debug(f"Saved image to {filepath}")
+            img_extension = config.image_format.lower() if config.image_format != 'JPEG' else 'jpg'
 
+            # Opening only parses the header; the pixel data is decoded when the image is written
+            with Image.open(BytesIO(image_data)) as img:
+                source_size = img.size
+                source_format, source_mode = img.format, img.mode
+                actual_width = width if width is not None else img.width
+                actual_height = height if height is not None else img.height
 
-                image_details = {
-                    'filepath': str(filepath),
-                    'filename': filename,
-                    'dimensions': f"{actual_width}x{actual_height}",
-                    'source': source_info,
-                    'hash': image_hash
-                }
+            if (actual_width < config.min_image_width or
+                actual_height < config.min_image_height):
+                self.logger.info(f"Skipping image {source_info} due to dimensions {actual_width}x{actual_height} < minimum {config.min_image_width}x{config.min_image_height}")
+                return None
 
-                if image_hash not in self.processed_images:
-                    self.image_log.append(image_details)
-                    self.processed_images.add(image_hash)
+            target_size = self.fit_size(source_size, config)
+            if target_size != source_size:
+                actual_width, actual_height = target_size
+            else:
+                target_size = None
+
+            # Nothing to convert, composite or scale: the original JPEG bytes are already the output
+            passthrough = (config.jpeg_passthrough and target_size is None and config.image_format == 'JPEG'
+                           and source_format == 'JPEG' and source_mode in ('RGB', 'L'))
+
+            # The name holds the size the current max_image_width/height produce, so a file saved
+            # under other limits never matches
+            filename = f"{image_hash.hex()}_{actual_width}x{actual_height}.{img_extension}"
+            filepath = self.image_dir / filename
+
+            image_details = {
+                'filepath': str(filepath),
+                'filename': filename,
+                'dimensions': f"{actual_width}x{actual_height}",
+                'source': source_info,
+                'hash': image_hash
+            }
+
+            if self._on_disk(filename):
+                # Saved by an earlier run: files only get their final name once fully written
+                self.logger.debug("Image file already exists: %s. Skipping save operation.", filepath)
+                self.image_log_by_hash[image_hash] = image_details
+            elif passthrough:
+                self._write_raw(filepath, image_data)
+                self.image_log_by_hash[image_hash] = image_details
+            elif config.image_encode_workers > 0:
+                # Registered before queueing so a failed background write can take the entry back out
+                self.image_log_by_hash[image_hash] = image_details
+                if self._encoder is None:
+                    self._encoder = ThreadPoolExecutor(max_workers=config.image_encode_workers,
+                                                       thread_name_prefix='image-encode')
+                self._pending_writes.append(self._encoder.submit(
+                    self._write_image_background, filepath, image_data, config, image_hash, target_size))
+            else:
+                self._write_image(filepath, image_data, config, target_size)
+                self.image_log_by_hash[image_hash] = image_details
 
-                return image_details
+            return image_details
 
         except Exception as e:
             # Use Vietnamese in error message if desired, otherwise English is fine
             self.logger.error(f"Lỗi khi lưu hình ảnh từ source '{source_info}': {str(e)}", exc_info=True)
             return None
 
+    def _save_svg(self, image_data: bytes, image_hash: bytes, source_info: str,
+                  width: Optional[int], height: Optional[int]) -> Dict[str, Any]:
+        """Copy an SVG image verbatim; it has no pixel size, so only tag dimensions are checked"""
+        filename = f"{image_hash.hex()}.svg"
+        filepath = self.image_dir / filename
+        if self._on_disk(filename):
+            self.logger.debug("Image file already exists: %s. Skipping save operation.", filepath)
+        else:
+            self._write_raw(filepath, image_data)
+        image_details = {
+            'filepath': str(filepath),
+            'filename': filename,
+            'dimensions': f"{width}x{height}" if width is not None and height is not None else 'vector',
+            'source': source_info,
+            'hash': image_hash
+        }
+        self.image_log_by_hash[image_hash] = image_details
+        return image_details
+
+    @staticmethod
+    def fit_size(size: Tuple[int, int], config: ExtractorConfig) -> Tuple[int, int]:
+        """Size the image is saved at: scaled down, keeping the aspect ratio, to fit max_image_width/height"""
+        width, height = size
+        scale = 1.0
+        if config.max_image_width and width > config.max_image_width:
+            scale = config.max_image_width / width
+        if config.max_image_height and height > config.max_image_height:
+            scale = min(scale, config.max_image_height / height)
+        if scale == 1.0:
+            return size
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    def _on_disk(self, filename: str) -> bool:
+        """Whether an earlier run already saved filename; .part files never match a final name"""
+        if self._names_on_disk is None:
+            self._names_on_disk = set(os.listdir(self.image_dir))
+            self.logger.debug(f"Found {len(self._names_on_disk)} files in {self.image_dir}")
+        return filename in self._names_on_disk
+
+    def _open_temp(self, filepath: Path) -> Tuple[int, Path]:
+        """Claim a hidden temporary file next to filepath with O_EXCL; _claim links it to filepath once fully written"""
+        # One image is only ever written once per run, so the pid alone keeps parallel runs apart
+        temp_path = filepath.with_name(f".{filepath.name}.{os.getpid()}.part")
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+        try:
+            return os.open(temp_path, flags, 0o644), temp_path
+        except FileExistsError:
+            # Left by a killed run that had the same pid
+            temp_path.unlink()
+            return os.open(temp_path, flags, 0o644), temp_path
+
+    def _claim(self, temp_path: Path, filepath: Path):
+        """Give the complete temporary file its final name. link() fails instead of overwriting, so the
+        final name is claimed exclusively and a killed run never leaves a truncated file under it"""
+        try:
+            os.link(temp_path, filepath)
+        except FileExistsError:
+            # A parallel run saved the same image first; its file is identical
+            self.logger.debug("Image file already exists: %s. Keeping it.", filepath)
+        except OSError:
+            os.replace(temp_path, filepath) # File systems without hard links
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+    def _write_image(self, filepath: Path, image_data: bytes, config: ExtractorConfig,
+                     target_size: Optional[Tuple[int, int]] = None):
+        """Decode, convert to RGB (scaled to target_size if given) and encode the image to filepath"""
+        fd, temp_path = self._open_temp(filepath)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with Image.open(BytesIO(image_data)) as img:
+                    if target_size:
+                        # JPEG only: libjpeg decodes straight at 1/2, 1/4 or 1/8 scale, no smaller than target_size
+                        img.draft('RGB', target_size)
+                    if img.mode == 'P':
+                        img = img.convert('RGBA')
+                    if img.mode in ('RGBA', 'LA'):
+                        # getchannel extracts only the alpha band; split() would copy every band
+                        output = Image.new('RGB', img.size, 'white')
+                        output.paste(img, mask=img.getchannel('A'))
+                    else:
+                        output = img.convert('RGB')
+                    if target_size and output.size != target_size:
+                        output = output.resize(target_size, Image.Resampling.LANCZOS)
+                    output.save(f, config.image_format, quality=config.quality)
+            self._claim(temp_path, filepath)
+        except Exception:
+            temp_path.unlink(missing_ok=True)
+            raise
+        self.logger.debug("Saved image to %s", filepath)
+
+    def _write_raw(self, filepath: Path, image_data: bytes):
+        """Write the original image bytes unchanged to filepath"""
+        fd, temp_path = self._open_temp(filepath)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(image_data)
+            self._claim(temp_path, filepath)
+        except Exception:
+            temp_path.unlink(missing_ok=True)
+            raise
+        self.logger.debug("Copied image unchanged to %s", filepath)
+
+    def _write_image_background(self, filepath: Path, image_data: bytes,
+                                config: ExtractorConfig, image_hash: bytes,
+                                target_size: Optional[Tuple[int, int]] = None):
+        try:
+            self._write_image(filepath, image_data, config, target_size)
+        except Exception as e:
+            # The XML already references this file; close() hands it back so the run is reported as failed
+            self.image_log_by_hash.pop(image_hash, None)
+            self.failed_writes.append(filepath.name)
+            self.logger.error(f"Lỗi khi ghi hình ảnh {filepath}: {str(e)}", exc_info=True)
+
+    def close(self) -> List[str]:
+        """Wait for queued image writes to finish and stop the encoder threads.
+        Returns the names of referenced image files that could not be written."""
+        if self._encoder is not None:
+            for future in self._pending_writes:
+                future.result()
+            self._pending_writes.clear()
+            self._encoder.shutdown()
+            self._encoder = None
+        return self.failed_writes
+
+class XMLContentWriter:
+    """Streams the structured content to the XML file element by element instead of buffering the whole book"""
+
+    DEFAULT_CHAPTER_ID = "ch_frontmatter"
+    DEFAULT_CHAPTER_TITLE = "Front Matter"
+    FLUSH_EVERY = 512 # Serialized fragments handed to the file per writelines() call
+
+    def __init__(self, xml_file: Path, config: ExtractorConfig, logger: logging.Logger,
+                 image_dir: Optional[Path] = None):
+        self.xml_file = xml_file
+        self.xml_dir = xml_file.parent
+        self.config = config
+        self.logger = logger
+        # Every saved image lives directly in image_dir, so its src prefix relative to the XML file is computed once
+        self.image_prefix = self._image_prefix(image_dir)
+        self.chapter_count = 0
+        self.paragraph_count = 0
+        self.image_count = 0
+        self.current_chapter_id: Optional[str] = None
+        # Digest of paragraph text -> id of its first occurrence
+        self.first_paragraph_ids: Dict[bytes, str] = {}
+        self.duplicate_count = 0
+        self._file = None
+        self._pending: List[str] = []
+        # Checked once so the per-item debug lines cost nothing when DEBUG is off
+        self.debug_on = logger.isEnabledFor(logging.DEBUG)
+        self._item_writers = {Paragraph: self._write_paragraph_item, ImageItem: self._write_image_item}
+
+    def _image_prefix(self, image_dir: Optional[Path]) -> str:
+        """Directory part of every image src, relative to the XML file"""
+        if image_dir is None:
+            image_dir = self.xml_dir / self.config.image_dir
+        try:
+            return os.path.relpath(image_dir, start=self.xml_dir).replace('\\', '/')
+        except ValueError:
+            self.logger.warning(f"Cannot create relative path for images in {image_dir} from {self.xml_dir}. Using default relative path.")
+            return self.config.image_dir
+
+    def __enter__(self) -> 'XMLContentWriter':
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(complete=exc_type is None)
+
+    def open(self):
+        """Open the output file and write the XML declaration and root tag"""
+        self.logger.info(f"Bắt đầu ghi file XML: {self.xml_file}")
+        # xmlcharrefreplace keeps characters the output encoding can't represent as valid XML
+        self._file = open(self.xml_file, 'w', encoding=self.config.output_encoding, errors='xmlcharrefreplace')
+        self._emit(f'<?xml version="1.0" encoding="{self.config.output_encoding}"?>\n<lightnovel>\n')
+
+    def close(self, complete: bool = True):
+        """Close any open chapter and the root tag, then close the file"""
+        if not self._file:
+            return
+        try:
+            if complete:
+                if self.current_chapter_id is not None:
+                    self._emit('  </chapter>\n')
+                self._emit('</lightnovel>\n')
+                self._flush()
+                if not (self.chapter_count or self.paragraph_count or self.image_count):
+                    self.logger.warning("No structured content was written. XML file will be minimal.")
+                if self.duplicate_count:
+                    self.logger.info(f"Đã đánh dấu {self.duplicate_count} đoạn văn trùng lặp (translate=\"no\", duplicate_of).")
+        finally:
+            self._file.close()
+            self._file = None
+            self._pending.clear()
+
+    def _emit(self, fragment: str):
+        """Queue a serialized fragment; fragments reach the file in batches, in order"""
+        self._pending.append(fragment)
+        if len(self._pending) >= self.FLUSH_EVERY:
+            self._flush()
+
+    def _flush(self):
+        self._file.writelines(self._pending)
+        self._pending.clear()
+
+    def start_chapter(self, title: str):
+        """Close the current chapter (if any) and open a new one"""
+        if self.current_chapter_id is not None:
+            self._emit('  </chapter>\n')
+        self.chapter_count += 1
+        self._open_chapter(f"ch{self.chapter_count}", title)
+        self.logger.debug("  Created XML chapter: id='%s', title='%s'", self.current_chapter_id, title)
+
+    def _open_chapter(self, chapter_id: str, title: str):
+        self._emit(f'  <chapter id={quoteattr(chapter_id)} title={quoteattr(title)}>\n')
+        self.current_chapter_id = chapter_id
+
+    def _ensure_chapter(self, item_kind: str):
+        """Open the front matter chapter for content found before any main chapter"""
+        if self.current_chapter_id is None:
+            self.logger.info(f"{item_kind} found before any main chapter. Creating '{self.DEFAULT_CHAPTER_TITLE}' chapter (ID: {self.DEFAULT_CHAPTER_ID}).")
+            self._open_chapter(self.DEFAULT_CHAPTER_ID, self.DEFAULT_CHAPTER_TITLE)
+
+    def write_paragraph(self, text: str, role: Optional[str] = None):
+        self._ensure_chapter("Paragraph")
+        self.paragraph_count += 1
+        para_id = f"p{self.paragraph_count}"
+        duplicate_of = None
+        if self.config.mark_duplicates and len(text) >= self.config.duplicate_min_length:
+            key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+            first_id = self.first_paragraph_ids.setdefault(key, para_id)
+            if first_id != para_id:
+                duplicate_of = first_id
+                self.duplicate_count += 1
+        # Attribute values are ids, "yes"/"no" and h1-h6 roles, none of which need escaping
+        attrs = f'id="{para_id}" translate="{"no" if duplicate_of else "yes"}"'
+        if role:
+            attrs += f' role="{role}"'
+        if duplicate_of:
+            # The translator reuses the translation of the first occurrence
+            attrs += f' duplicate_of="{duplicate_of}"'
+        if _ESCAPE_RE.search(text):
+            text = escape(text)
+        self._emit(f'    <paragraph {attrs}>\n      <text>{text}</text>\n    </paragraph>\n')
+        if self.debug_on:
+            self.logger.debug("  Added XML paragraph: id='%s' to chapter %s", para_id, self.current_chapter_id)
+
+    def write_image(self, filename: str, alt: str):
+        self._ensure_chapter("Image")
+        self.image_count += 1
+        relative_image_path = f"{self.image_prefix}/{filename}"
+        self._emit(f'    <image id="img{self.image_count}" src={quoteattr(relative_image_path)} alt={quoteattr(alt)} />\n')
+        if self.debug_on:
+            self.logger.debug("  Added XML image: id='img%d', src='%s' to chapter %s", self.image_count, relative_image_path, self.current_chapter_id)
+
+    def write_item(self, item: ContentItem):
+        """Write a paragraph/image item as produced by ContentProcessor"""
+        handler = self._item_writers.get(type(item))
+        if handler is None:
+            self.logger.warning(f"Unknown structured item type encountered: '{type(item).__name__}'. Skipping.")
+            return
+        handler(item)
+
+    def _write_paragraph_item(self, item: Paragraph):
+        self.write_paragraph(item.text, item.role)
+
+    def _write_image_item(self, item: ImageItem):
+        self.write_image(item.filename, item.alt)
+
 class ContentProcessor:
     """Handles content extraction and processing into a structured list"""
 
     def __init__(self, book: epub.EpubBook, image_processor: ImageProcessor,
-                 logger: logging.Logger):
+                 writer: XMLContentWriter, logger: logging.Logger,
+                 href_index: Optional[Dict[str, epub.EpubItem]] = None):
         self.book = book
+        # Item href variants -> item, built once by EPUBProcessor.build_href_index
+        self.href_index: Dict[str, epub.EpubItem] = href_index if href_index is not None else {}
         self.image_processor = image_processor
+        self.writer = writer
         self.logger = logger
-        self.structured_content: List[Dict[str, Any]] = []
         self.current_chapter_href: Optional[str] = None
-
-    def extract_image_data(self, href: str, base_href: Optional[str] = None) -> Optional[bytes]:
-        """Extract image data from EPUB by href, considering relative paths"""
+        # Serialized <ruby> markup -> formatted text
+        self._ruby_cache: Dict[str, str] = {}
+        # EPUB item name -> (bytes, hash), so an image referenced many times is hashed once
+        self.image_data_cache: Dict[str, Tuple[bytes, bytes]] = {}
+        # (document dir, src) -> filename of the saved image; a repeated reference
+        # (cover, chapter header art) skips href resolution and the save() call entirely
+        self.resolved_images: Dict[Tuple[str, str], str] = {}
+
+    def extract_image_data(self, href: str, ctx: Optional[DocumentContext] = None) -> Optional[Tuple[bytes, bytes]]:
+        """Extract image data and its content hash from EPUB by href, considering relative paths"""
         try:
             if href.startswith('data:image'):
-                header, encoded = href.split(',', 1)
-                return base64.b64decode(encoded)
+                # Slice the payload off directly; split() would also copy the header into a tuple
+                comma = href.find(',')
+                if comma < 0:
+                    self.logger.warning(f"Malformed data-URI image (no ',' before the payload): '{href[:60]}...'")
+                    return None
+                data = decode_data_uri(href[comma + 1:])
+                return data, self.image_processor.compute_hash(data)
 
             absolute_href = href
-            if base_href and not href.startswith(('http://', 'https://', '/')):
-                 base_path = Path(base_href).parent
-                 absolute_href = str(base_path / href).replace('\\', '/')
+            if ctx and ctx.base_dir and not href.startswith(('http://', 'https://', '/')):
+                 # Pure string ops; normpath folds '../image/x.jpg' from 'item/xhtml' into 'item/image/x.jpg'
+                 absolute_href = posixpath.normpath(posixpath.join(ctx.base_dir, href))
 
             decoded_href = urllib.parse.unquote(absolute_href)
             potential_hrefs = [
                 decoded_href,
                 absolute_href,
                 href,
-                decoded_href.lstrip('./').lstrip('../'),
-                absolute_href.lstrip('./').lstrip('../'),
-                href.lstrip('./').lstrip('../')
+                _PREFIX_RE.sub('', decoded_href),
+                _PREFIX_RE.sub('', absolute_href),
+                _PREFIX_RE.sub('', href)
             ]
             # Add the direct href and its unquoted version to the beginning of the list
             # to prioritize direct matches, especially for paths like 'item/xhtml/p-001.xhtml'
@@ -201,221 +667,304 @@ class ContentProcessor:
 
             unique_hrefs = list(dict.fromkeys(potential_hrefs)) # Remove duplicates while preserving order
 
+            get_item = self.href_index.get
             for test_href in unique_hrefs:
-                item = self.book.get_item_with_href(test_href)
+                item = get_item(test_href)
                 if item:
-                    self.logger.debug(f"Found image item for href '{href}' (resolved as '{test_href}')")
-                    return item.get_content()
-
-            self.logger.warning(f"Could not find EPUB item for image href: '{href}' (Base: '{base_href}', Attempt: '{absolute_href}')")
+                    self.logger.debug("Found image item for href '%s' (resolved as '%s')", href, test_href)
+                    item_name = item.get_name()
+                    cached = self.image_data_cache.get(item_name)
+                    if cached is None:
+                        data = item.get_content()
+                        cached = (data, self.image_processor.compute_hash(data))
+                        self.image_data_cache[item_name] = cached
+                    return cached
+
+            self.logger.warning(f"Could not find EPUB item for image href: '{href}' (Base: '{ctx.base_href if ctx else None}', Attempt: '{absolute_href}')")
             return None
         except Exception as e:
             self.logger.error(f"Lỗi khi trích xuất dữ liệu hình ảnh cho href '{href}': {str(e)}")
             return None
 
-    def process_image(self, tag: Tag, context: str, config: ExtractorConfig, base_href: Optional[str]) -> Optional[Dict[str, Any]]:
-        """Process image tag, save image, return structured data for XML."""
-        image_info = None
-        if tag.name in ['img', 'image']:
+    def image_ref(self, tag: Tag, context: str, ctx: DocumentContext) -> Optional[ImageRef]:
+        """Describe an image tag without touching the EPUB, so it can be resolved later by resolve_image."""
+        if tag.name in _IMAGE_TAGS:
             src = self.image_processor.get_source(tag)
             if src:
-                image_data = self.extract_image_data(src, base_href)
-                if image_data:
-                    width, height = self.image_processor.get_dimensions(tag)
-                    source_info = f"Context: {context}, Source Tag: <{tag.name} src='{src}'> in doc '{base_href}'"
-                    saved_image_details = self.image_processor.save(
-                        image_data, source_info, width, height, config)
-                    if saved_image_details:
-                        image_info = {
-                            "type": "image",
-                            "filepath": saved_image_details['filepath'],
-                            "filename": saved_image_details['filename'],
-                            "alt": f"Image from {context}"
-                        }
-                else:
-                    self.logger.warning(f"Could not extract image data for src='{src}' in context '{context}' from doc '{base_href}'")
-            else:
-                 self.logger.debug(f"Skipping tag <{tag.name}> in context '{context}' - no valid source attribute found.")
-        return image_info
+                width, height = self.image_processor.get_dimensions(tag)
+                return ImageRef(src, width, height, context, tag.name)
+            self.logger.debug("Skipping tag <%s> in context '%s' - no valid source attribute found.", tag.name, context)
+        return None
+
+    def svg_image_refs(self, svg: Tag, context: str, ctx: DocumentContext) -> List[ImageRef]:
+        """ImageRefs for the <image> elements inside an <svg>, in one pass over its descendants"""
+        refs = []
+        for node in svg.descendants:
+            if type(node) is Tag and node.name == 'image':
+                if image_info := self.image_ref(node, context, ctx):
+                    refs.append(image_info)
+        return refs
+
+    def resolve_image(self, image_ref: ImageRef, config: ExtractorConfig, ctx: DocumentContext) -> Optional[ImageItem]:
+        """Extract and save the image behind an ImageRef, return structured data for XML."""
+        src = image_ref.src
+        context = image_ref.context
+        # Data URIs have their own decode cache and would make very large keys here
+        cache_key = None if src.startswith('data:') else (ctx.base_dir, src)
+        saved = self.resolved_images.get(cache_key) if cache_key else None
+        if saved:
+            return ImageItem(saved, f"Image from {context}")
+        extracted = self.extract_image_data(src, ctx)
+        if not extracted:
+            self.logger.warning(f"Could not extract image data for src='{src}' in context '{context}' from doc '{ctx.base_href}'")
+            return None
+        image_data, image_hash = extracted
+        source_info = f"Context: {context}, Source Tag: <{image_ref.tag_name} src='{src}'> in doc '{ctx.base_href}'"
+        saved_image_details = self.image_processor.save(
+            image_data, source_info, image_ref.width, image_ref.height, config,
+            precomputed_hash=image_hash)
+        if not saved_image_details:
+            # Rejections are not cached: a later reference with larger tag dimensions may still be saved
+            return None
+        if cache_key:
+            self.resolved_images[cache_key] = saved_image_details['filename']
+        return ImageItem(saved_image_details['filename'], f"Image from {context}")
 
     def process_ruby(self, tag: Tag) -> str:
         """Process ruby text formatting (extracts base + phonetic)"""
         if tag.name == 'ruby':
-            base = tag.find('rb')
-            rt = tag.find('rt')
-            rp_open = tag.find('rp', string='（') or tag.find('rp', string='(')
-            rp_close = tag.find('rp', string='）') or tag.find('rp', string=')')
-
-            base_text = base.get_text().strip() if base else ''
-            rt_text = rt.get_text().strip() if rt else ''
-
-            # If rt exists, try to reconstruct with optional rp
-            if base_text and rt_text:
-                open_paren = "（" if rp_open else "("
-                close_paren = "）" if rp_close else ")"
-                return f"{base_text}{open_paren}{rt_text}{close_paren}"
-            elif base_text: # Only base exists
-                return base_text
-            else: # Fallback to tag text if structure is weird
-                return tag.get_text().strip()
+            # Names and places repeat the same furigana throughout a book; the markup itself is the key
+            key = str(tag)
+            ruby_text = self._ruby_cache.get(key)
+            if ruby_text is None:
+                ruby_text = self._ruby_cache[key] = self._format_ruby(tag)
+            return ruby_text
         # Fallback for non-ruby tags
         return tag.get_text().strip()
 
+    def _format_ruby(self, tag: Tag) -> str:
+        """Format a <ruby> tag as base（reading）"""
+        base = tag.find('rb')
+        rt = tag.find('rt')
+        rp_open = tag.find('rp', string='（') or tag.find('rp', string='(')
+        rp_close = tag.find('rp', string='）') or tag.find('rp', string=')')
+
+        base_text = base.get_text().strip() if base else ''
+        rt_text = rt.get_text().strip() if rt else ''
+
+        # If rt exists, try to reconstruct with optional rp
+        if base_text and rt_text:
+            open_paren = "（" if rp_open else "("
+            close_paren = "）" if rp_close else ")"
+            return f"{base_text}{open_paren}{rt_text}{close_paren}"
+        elif base_text: # Only base exists
+            return base_text
+        else: # Fallback to tag text if structure is weird
+            return tag.get_text().strip()
+
 
     # *** REPLACED process_tag_content ***
-    def process_tag_content(self, tag: Tag, config: ExtractorConfig, context: str, base_href: str) -> List[Dict[str, Any]]:
+    def process_tag_content(self, tag: Tag, config: ExtractorConfig, context: str, ctx: DocumentContext) -> List[ContentItem]:
         """Recursively process content, accumulating text across nodes and handling block/inline elements."""
         items = []
-        current_text_fragments = [] # Accumulates text pieces for the current paragraph
+        text_buf = StringIO() # Accumulates text pieces for the current paragraph
+        write_text = text_buf.write
 
-        self.logger.debug(f"Entering process_tag_content for <{tag.name}> context: {context} in {base_href}")
+        # Checked once per call; the per-node debug messages below are only built when DEBUG is on
+        debug_on = self.logger.isEnabledFor(logging.DEBUG)
+        if debug_on:
+            self.logger.debug(f"Entering process_tag_content for <{tag.name}> context: {context} in {ctx.base_href}")
 
         # Helper function to flush accumulated text as a paragraph
         def flush_text():
-            nonlocal current_text_fragments
-            if current_text_fragments:
-                # Join fragments, then strip leading/trailing whitespace from the combined string
-                full_text = ''.join(current_text_fragments).strip()
-                # Replace multiple internal whitespaces (including newlines) with a single space
-                full_text = ' '.join(full_text.split())
+            if text_buf.tell():
+                # Collapse every whitespace run (including newlines) to one space in a single pass, then trim the ends
+                full_text = _WS_RE.sub(' ', text_buf.getvalue()).strip()
                 if full_text:
-                    self.logger.debug(f"  Flushing paragraph: '{full_text[:100]}...'")
-                    items.append({"type": "paragraph", "text": full_text})
-                current_text_fragments = [] # Reset fragments
+                    if debug_on:
+                        self.logger.debug(f"  Flushing paragraph: '{full_text[:100]}...'")
+                    items.append(Paragraph(full_text))
+                # Reset the buffer in place
+                text_buf.seek(0)
+                text_buf.truncate(0)
 
         try:
-            for elem in tag.contents:
-                if isinstance(elem, str):
+            for elem in tag.children:
+                # Exact type checks first; isinstance is only the fallback for rarer subclasses (comments, CDATA...)
+                elem_type = type(elem)
+                if elem_type is NavigableString or (elem_type is not Tag and isinstance(elem, str)):
                     # Keep internal whitespace for now, handle in flush_text
-                    text = elem
-                    if text.strip():
-                        self.logger.debug(f"  Processing text node: '{text.strip()[:50]}...'")
-                    # Append raw text to fragments
-                    current_text_fragments.append(text)
+                    write_text(elem)
 
-                elif isinstance(elem, Tag):
+                elif elem_type is Tag or isinstance(elem, Tag):
                     tag_name = elem.name
-                    self.logger.debug(f"  Processing child tag: <{tag_name}>")
 
                     # --- Block-level elements that typically enforce paragraph breaks ---
                     # Added more potential block elements found in EPUBs
-                    if tag_name in ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'div', 'section',
-                                    'article', 'main', 'figure', 'figcaption', 'blockquote', 'pre',
-                                    'ul', 'ol', 'li', 'dl', 'dt', 'dd', 'table', 'hr', 'header', 'footer', 'aside']:
+                    if tag_name in _BLOCK_TAGS:
                         flush_text() # Finish any preceding paragraph
 
                         # Handle specific block tags if needed, otherwise recurse
-                        if tag_name in ['img', 'image']: # Should ideally not be *inside* other blocks, but handle defensively
-                             if image_info := self.process_image(elem, f"{context} > {tag_name}", config, base_href):
+                        if tag_name in _IMAGE_TAGS: # Should ideally not be *inside* other blocks, but handle defensively
+                             if image_info := self.image_ref(elem, f"{context} > {tag_name}", ctx):
                                 items.append(image_info)
                         elif tag_name == 'svg':
-                            for svg_img in elem.find_all('image'):
-                                 if image_info := self.process_image(svg_img, f"{context} > {tag_name} SVG", config, base_href):
-                                     items.append(image_info)
+                            items.extend(self.svg_image_refs(elem, f"{context} > {tag_name} SVG", ctx))
                         else:
                              # Recursively process the block tag's content
-                             self.logger.debug(f"  Recursing into block child <{tag_name}>")
-                             nested_items = self.process_tag_content(elem, config, f"{context} > {tag_name}", base_href)
+                             if debug_on:
+                                 self.logger.debug(f"  Recursing into block child <{tag_name}>")
+                             nested_items = self.process_tag_content(elem, config, f"{context} > {tag_name}", ctx)
                              # Add role for headings processed recursively
-                             if tag_name in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
+                             if tag_name in _HEADING_TAGS:
+                                 role = sys.intern(tag_name) # One shared 'h1'..'h6' string for every heading paragraph
                                  for nested_item in nested_items:
-                                     if nested_item['type'] == 'paragraph':
-                                         nested_item['role'] = tag_name # Mark paragraphs coming from headings
+                                     if type(nested_item) is Paragraph:
+                                         nested_item.role = role # Mark paragraphs coming from headings
                              items.extend(nested_items)
 
                         flush_text() # Ensure break *after* the block element
 
                     # --- Standalone Images (often treated as block) ---
-                    elif tag_name in ['img', 'image']:
+                    elif tag_name in _IMAGE_TAGS:
                         flush_text()
-                        if image_info := self.process_image(elem, context, config, base_href):
+                        if image_info := self.image_ref(elem, context, ctx):
                             items.append(image_info)
                         flush_text()
 
                     elif tag_name == 'svg':
                         flush_text()
-                        svg_images_found = False
-                        for svg_img in elem.find_all('image'):
-                            if image_info := self.process_image(svg_img, f"{context} SVG", config, base_href):
-                                items.append(image_info)
-                                svg_images_found = True
-                        if not svg_images_found:
+                        svg_refs = self.svg_image_refs(elem, f"{context} SVG", ctx)
+                        items.extend(svg_refs)
+                        if not svg_refs and debug_on:
                              self.logger.debug(f"  SVG tag <{elem.name}> did not contain processable <image> tags.")
                         flush_text()
 
                     # --- Line breaks ---
                     elif tag_name == 'br':
-                        # Append a space to fragments if needed
-                        if current_text_fragments and not current_text_fragments[-1].strip().endswith(' '):
-                             current_text_fragments.append(' ')
-                        self.logger.debug("  Processed <br> as space.")
+                        # Separate the lines with a space once some text has been collected
+                        if text_buf.tell():
+                             write_text(' ')
 
                     # --- Ruby characters ---
                     elif tag_name == 'ruby':
                          ruby_text = self.process_ruby(elem)
-                         self.logger.debug(f"  Processing ruby tag, text: {ruby_text}")
-                         current_text_fragments.append(ruby_text)
+                         if debug_on:
+                             self.logger.debug(f"  Processing ruby tag, text: {ruby_text}")
+                         write_text(ruby_text)
 
                     # --- Other tags (assumed inline or container to be recursed into) ---
                     else:
-                        self.logger.debug(f"  Recursing into inline/unknown child <{tag_name}>")
-                        inline_items = self.process_tag_content(elem, config, f"{context} > {tag_name}", base_href)
-                        # Append text from inline items to current fragments
+                        if debug_on:
+                            self.logger.debug(f"  Recursing into inline/unknown child <{tag_name}>")
+                        inline_items = self.process_tag_content(elem, config, f"{context} > {tag_name}", ctx)
+                        # Append text from inline items to the text buffer
                         for item in inline_items:
-                            if item['type'] == 'paragraph':
+                            if type(item) is Paragraph:
                                 # Append text, let flush handle joining/spacing
-                                current_text_fragments.append(item['text'])
-                            elif item['type'] == 'image':
+                                write_text(item.text)
+                            elif type(item) is ImageRef:
                                 # If images appear inside inline elements, flush text first, add image, flush again
                                 flush_text()
-                                self.logger.warning(f"Adding image found inside suspected inline tag <{tag_name}>: {item.get('filename')}")
+                                self.logger.warning(f"Adding image found inside suspected inline tag <{tag_name}>: {item.src}")
                                 items.append(item)
                                 flush_text()
 
 
         except Exception as e_tag_content:
-            self.logger.error(f"Lỗi bên trong process_tag_content cho <{tag.name}> context: {context} in {base_href}: {e_tag_content}", exc_info=True)
+            self.logger.error(f"Lỗi bên trong process_tag_content cho <{tag.name}> context: {context} in {ctx.base_href}: {e_tag_content}", exc_info=True)
 
         # Flush any remaining text at the end
         flush_text()
 
-        self.logger.debug(f"Exiting process_tag_content for <{tag.name}>. Items found: {len(items)}")
+        if debug_on:
+            self.logger.debug(f"Exiting process_tag_content for <{tag.name}>. Items found: {len(items)}")
         return items
 
 
-    # *** MODIFIED process_document_item ***
-    def process_document_item(self, item: ebooklib.epub.EpubHtml, config: ExtractorConfig):
-        """Process a single EPUB document item and add structured content."""
+    def extract_document_items(self, content: bytes, base_href: str, config: ExtractorConfig) -> List[ContentItem]:
+        """Parse one EPUB document into structured items; images stay as unresolved ImageRef items."""
+        items: List[ContentItem] = []
         try:
-            base_href = urllib.parse.unquote(item.get_name())
+            ctx = DocumentContext.from_href(base_href)
             self.logger.info(f"Processing document item: {base_href}")
 
-            soup = BeautifulSoup(item.get_content(), config.parser)
+            soup = BeautifulSoup(content, config.parser, parse_only=_BODY_STRAINER)
             body = soup.find('body')
 
             if not body:
                 self.logger.warning(f"No <body> tag found in document: {base_href}. Skipping content extraction for this item.")
-                return
-
-            # --- MODIFICATION START ---
-            # Check for direct children first
-            direct_children = body.find_all(recursive=False)
-            if not direct_children:
-                 # If no direct children, process the body tag itself
+                return items
+
+            # Single walk over the body, flattening layout-only div/section/article wrappers
+            found_children = False
+            for tag in _walk(body):
+                found_children = True
+                tag_name = tag.name
+                context = f"Child <{tag_name}>"
+                if tag_name in _IMAGE_TAGS:
+                    if image_info := self.image_ref(tag, context, ctx):
+                        items.append(image_info)
+                elif tag_name == 'svg':
+                    items.extend(self.svg_image_refs(tag, f"{context} SVG", ctx))
+                else:
+                    tag_content = self.process_tag_content(tag, config, context, ctx)
+                    if tag_name in _HEADING_TAGS:
+                        role = sys.intern(tag_name)
+                        for content_item in tag_content:
+                            if type(content_item) is Paragraph:
+                                content_item.role = role
+                    items.extend(tag_content)
+
+            if not found_children:
+                 # If no child tags, process the body tag itself
                  self.logger.warning(f"No direct children found under <body> in {base_href}. Processing body tag directly.")
-                 body_content = self.process_tag_content(body, config, "Body Direct", base_href)
-                 self.structured_content.extend(body_content)
-            else:
-                 # If direct children exist, process them individually
-                 self.logger.debug(f"Found {len(direct_children)} direct children in <body>. Processing them.")
-                 for tag in direct_children:
-                     # Use process_tag_content to handle all tags uniformly
-                     tag_content = self.process_tag_content(tag, config, f"Child <{tag.name}>", base_href)
-                     self.structured_content.extend(tag_content)
-            # --- MODIFICATION END ---
+                 items.extend(self.process_tag_content(body, config, "Body Direct", ctx))
 
         except Exception as e:
-            self.logger.error(f"Lỗi khi xử lý document item {item.get_name()}: {str(e)}", exc_info=True)
+            self.logger.error(f"Lỗi khi xử lý document item {base_href}: {str(e)}", exc_info=True)
+        return items
+
+    def write_document_items(self, items: List[ContentItem], config: ExtractorConfig, ctx: DocumentContext):
+        """Resolve ImageRef items against the EPUB and stream everything to the writer in order."""
+        write_item = self.writer.write_item
+        for content_item in items:
+            if type(content_item) is ImageRef:
+                content_item = self.resolve_image(content_item, config, ctx)
+                if not content_item:
+                    continue
+            write_item(content_item)
+
+
+# Per-worker state, built once by _init_worker; the ContentProcessor caches (ruby text...) carry over between documents
+_worker_processor: Optional[ContentProcessor] = None
+_worker_config: Optional[ExtractorConfig] = None
+# (level, message) of the records logged while parsing the current document
+_worker_records: List[Tuple[int, str]] = []
+
+class _RecordCollector(logging.Handler):
+    """Keeps a worker's log records so they travel back to the main process with the document's items"""
+    def emit(self, record: logging.LogRecord):
+        _worker_records.append((record.levelno, record.getMessage()))
+
+def _init_worker(config: ExtractorConfig):
+    """ProcessPoolExecutor initializer: set up the worker's logger and ContentProcessor once"""
+    global _worker_processor, _worker_config
+    logger = logging.getLogger(f"{__name__}.worker")
+    logger.setLevel(getattr(logging, str(config.log_level).upper(), logging.INFO))
+    # Not the parent's handlers: forked workers would write to the log file from several processes at once
+    logger.propagate = False
+    logger.handlers = [_RecordCollector()]
+    _worker_processor = ContentProcessor(None, ImageProcessor(None, logger), None, logger)
+    _worker_config = config
+
+def _process_doc(raw_bytes: bytes, base_href: str) -> Tuple[List[ContentItem], List[Tuple[int, str]]]:
+    """Worker entry point for ProcessPoolExecutor: parse one spine document from picklable inputs only.
+    Returns the items and the records logged while parsing, for the main process to log."""
+    items = _worker_processor.extract_document_items(raw_bytes, base_href, _worker_config)
+    records = _worker_records[:]
+    _worker_records.clear()
+    return items, records
 
 
 class EPUBProcessor:
@@ -431,11 +980,18 @@ class EPUBProcessor:
         self.image_dir.mkdir(parents=True, exist_ok=True)
 
         self.setup_logging()
+        if self.config.parser == 'lxml' and lxml is None:
+            self.logger.warning("lxml chưa được cài đặt, dùng parser 'html.parser' (chậm hơn).")
+            self.config = replace(self.config, parser='html.parser')
 
         self.image_processor = ImageProcessor(self.image_dir, self.logger)
         self.book: Optional[epub.EpubBook] = None
         self.content_processor: Optional[ContentProcessor] = None
         self.chapters: List[Tuple[str, str]] = []
+        # Normalized href -> chapter title, filled alongside self.chapters (a later nav link wins)
+        self.chapter_by_href: Dict[str, str] = {}
+        self.href_index: Dict[str, epub.EpubItem] = {}
+        self.id_index: Dict[str, epub.EpubItem] = {}
 
     def setup_logging(self):
         """Thiết lập logging với encoding UTF-8"""
@@ -444,7 +1000,7 @@ class EPUBProcessor:
         for handler in logging.root.handlers[:]:
             logging.root.removeHandler(handler)
         logging.basicConfig(
-            level=logging.DEBUG, # Keep DEBUG for detailed analysis
+            level=getattr(logging, str(self.config.log_level).upper(), logging.INFO),
             format=log_format,
             handlers=[
                 logging.FileHandler(log_file, mode='w', encoding='utf-8'),
@@ -455,6 +1011,25 @@ class EPUBProcessor:
         self.logger.info(f"Logging đã được thiết lập. Log file: {log_file}")
 
 
+    def build_href_index(self) -> Dict[str, epub.EpubItem]:
+        """Map every item href variant (raw, unquoted, without a common root folder) to its item in one pass"""
+        index: Dict[str, epub.EpubItem] = {}
+        stripped: List[Tuple[str, epub.EpubItem]] = []
+        common_roots = ('OEBPS/', 'OPS/', 'EPUB/')
+        for item in self.book.get_items():
+            name = item.get_name()
+            unquoted = urllib.parse.unquote(name)
+            index.setdefault(name, item)
+            index.setdefault(unquoted, item)
+            for root in common_roots:
+                if unquoted.startswith(root):
+                    stripped.append((unquoted[len(root):], item))
+        # Stripped variants go in last so they never shadow a real item name
+        for key, item in stripped:
+            index.setdefault(key, item)
+        self.logger.debug(f"Built href index: {len(index)} keys for the EPUB items")
+        return index
+
     def extract_metadata(self) -> Dict[str, str]:
         """Trích xuất metadata từ EPUB (không thêm vào XML theo format yêu cầu)"""
         if not self.book:
@@ -480,6 +1055,7 @@ class EPUBProcessor:
             return
         nav_item = None
         self.chapters = []
+        self.chapter_by_href = {}
         specific_nav_file_name = "navigation-documents.xhtml" # Target specific file
 
         self.logger.info(f"Đang tìm tài liệu điều hướng cụ thể: '{specific_nav_file_name}'...")
@@ -506,7 +1082,8 @@ class EPUBProcessor:
             nav_doc_base_href = urllib.parse.unquote(nav_item.get_name())
             # Ensure nav_doc_base_href is a directory path if it's a file, for urljoin
             if not nav_doc_base_href.endswith('/'):
-                 nav_doc_base_href = str(Path(nav_doc_base_href).parent) + '/'
+                 nav_dir = posixpath.dirname(nav_doc_base_href)
+                 nav_doc_base_href = nav_dir + '/' if nav_dir else ''
 
             soup = BeautifulSoup(content, self.config.parser)
             # Look for <nav epub:type="toc"> specifically as per navigation-documents.xhtml structure
@@ -517,31 +1094,22 @@ class EPUBProcessor:
                 for link in nav_toc.find_all('a', href=True):
                     href_raw = link['href']
                     if not href_raw or href_raw.startswith('#'):
-                        self.logger.debug(f"Bỏ qua liên kết nav với href trống hoặc chỉ là fragment: {href_raw}")
+                        self.logger.debug("Bỏ qua liên kết nav với href trống hoặc chỉ là fragment: %s", href_raw)
                         continue
 
                     # Resolve href relative to the navigation document's path
                     # Example: if nav_doc_base_href is 'item/' and href_raw is 'xhtml/p-001.xhtml',
                     # resolved should be 'item/xhtml/p-001.xhtml'
                     href_resolved = urllib.parse.urljoin(nav_doc_base_href, href_raw)
-                    normalized_href = urllib.parse.unquote(href_resolved).split('#')[0]
-                    # Normalize path for consistency (e.g. remove './', '../', convert '\' to '/')
-                    # The key is to match how spine items are normalized later.
-                    # A common approach is to make it relative to the EPUB root.
-                    # For `item/xhtml/p-001.xhtml`, it should remain as such if 'item' is a root-level dir in OPF manifest.
-                    # If `extract_image_data` uses `item/` as a base, this should align.
-                    # Let's assume paths in nav are relative to EPUB root or a known base like 'item/'
-                    # The `Path(normalized_href).as_posix()` can help standardize.
-                    # And then ensure it matches the format used in `process_content` for `item_href_normalized`
-                    normalized_href = str(Path(normalized_href).as_posix()).lstrip('./')
-                    # If the EPUB structure has a common base like 'item/', ensure it's part of normalized_href
-                    # This needs to be consistent with how spine hrefs are processed.
-                    # For now, we assume the resolved href is already correct relative to the EPUB root or a common base.
+                    # Same normalization as the spine hrefs in process_content, so the chapter map keys match exactly
+                    normalized_href = _normalize_href(href_resolved)
 
                     if normalized_href:
                         link_text = ' '.join(link.stripped_strings) or f"Liên kết không tên {len(self.chapters) + 1}"
                         self.chapters.append((normalized_href, link_text))
-                        self.logger.debug(f"Thêm chương (từ {specific_nav_file_name}): '{link_text}' -> '{normalized_href}' (Raw: '{href_raw}', Resolved: '{href_resolved}')")
+                        self.chapter_by_href[normalized_href] = link_text
+                        self.logger.debug("Thêm chương (từ %s): '%s' -> '%s' (Raw: '%s', Resolved: '%s')",
+                                          specific_nav_file_name, link_text, normalized_href, href_raw, href_resolved)
                     else:
                         self.logger.warning(f"Bỏ qua liên kết nav với href trống sau khi chuẩn hóa: {href_raw}")
             else:
@@ -553,170 +1121,101 @@ class EPUBProcessor:
 
 
     def process_content(self):
-        """Process EPUB content items based on spine order and add to structured list."""
+        """Process EPUB content items based on spine order, streaming them to the XML writer."""
         if not self.book or not self.content_processor:
             self.logger.error("Book or ContentProcessor not initialized.")
             return
         self.logger.info("Bắt đầu xử lý nội dung theo thứ tự spine...")
         processed_hrefs = set()
-        chapter_href_map = {href: title for href, title in self.chapters}
+        mark_processed = processed_hrefs.add
+        get_chapter_title = self.chapter_by_href.get
+        documents: List[Tuple[epub.EpubItem, Optional[str]]] = []
+        # Per-item logging uses lazy %-formatting; debug messages are skipped entirely when DEBUG is off
+        log_info = self.logger.info
+        log_debug = self.logger.debug
+        debug_on = self.logger.isEnabledFor(logging.DEBUG)
         spine_order_ids = self.book.spine
         for item_identifier, _ in spine_order_ids:
-            item = self.book.get_item_with_href(item_identifier)
+            # Spine entries are normally idrefs, but some EPUBs list hrefs; both are O(1) lookups
+            item = self.href_index.get(item_identifier) or self.id_index.get(item_identifier)
             if not item:
-                self.logger.warning(f"Could not find item with identifier '{item_identifier}' (href) from spine. Trying by ID...")
-                item_by_id = self.book.get_item_with_id(item_identifier)
-                if item_by_id:
-                    item = item_by_id
-                    self.logger.info(f"Found item by ID instead: {item_identifier}")
-                else:
-                    self.logger.error(f"Failed to retrieve item for spine identifier: {item_identifier}. Skipping.")
-                    continue
-            if item.get_type() == ebooklib.ITEM_DOCUMENT:
+                self.logger.error(f"Failed to retrieve item for spine identifier: {item_identifier}. Skipping.")
+                continue
+            item_type = item.get_type()
+            if item_type == ebooklib.ITEM_DOCUMENT:
                 item_href_raw = item.get_name()
-                item_href_normalized = urllib.parse.unquote(item_href_raw).split('#')[0]
-                item_href_normalized = str(Path(item_href_normalized)).replace('\\', '/').lstrip('./').lstrip('../')
+                item_href_normalized = _normalize_href(item_href_raw)
                 if item_href_normalized in processed_hrefs:
-                    self.logger.debug(f"Skipping already processed item: {item_href_normalized} (Raw: {item_href_raw})")
+                    if debug_on:
+                        log_debug("Skipping already processed item: %s (Raw: %s)", item_href_normalized, item_href_raw)
                     continue
-                self.logger.info(f"Processing spine item: {item_href_normalized} (Raw: {item_href_raw}, ID: {item_identifier})")
-                if item_href_normalized in chapter_href_map:
-                    chapter_title = chapter_href_map[item_href_normalized]
-                    self.logger.info(f"Chapter start detected: '{chapter_title}' for item {item_href_normalized}")
-                    self.content_processor.structured_content.append({
-                        "type": "chapter_start",
-                        "title": chapter_title,
-                        "href": item_href_normalized
-                    })
-                self.content_processor.process_document_item(item, self.config)
-                processed_hrefs.add(item_href_normalized)
-            else:
-                self.logger.debug(f"Skipping non-document spine item: {item.get_name()} (ID: {item_identifier}, Type: {item.get_type()})")
-        self.logger.info(f"Hoàn thành xử lý nội dung. Tìm thấy {len(self.content_processor.structured_content)} mục cấu trúc.")
-
-
-    def save_results_xml(self):
-        """Save processing results as a structured XML file based on structured_content."""
-        if not self.content_processor:
-            self.logger.error("Content processor not available, cannot save XML.")
+                log_info("Processing spine item: %s (Raw: %s, ID: %s)", item_href_normalized, item_href_raw, item_identifier)
+                # Single lookup; chapter titles are never None (nav links fall back to a placeholder title)
+                chapter_title = get_chapter_title(item_href_normalized)
+                if chapter_title is not None:
+                    log_info("Chapter start detected: '%s' for item %s", chapter_title, item_href_normalized)
+                documents.append((item, chapter_title))
+                mark_processed(item_href_normalized)
+            elif debug_on:
+                log_debug("Skipping non-document spine item: %s (ID: %s, Type: %s)", item.get_name(), item_identifier, item_type)
+        writer = self.content_processor.writer
+        for item, chapter_title, base_href, items in self.parse_documents(documents):
+            if chapter_title is not None:
+                writer.start_chapter(chapter_title)
+            self.content_processor.write_document_items(items, self.config, DocumentContext.from_href(base_href))
+        self.logger.info(f"Hoàn thành xử lý nội dung. Đã ghi {writer.chapter_count} chương, {writer.paragraph_count} đoạn văn, {writer.image_count} hình ảnh.")
+
+
+    def parse_documents(self, documents: List[Tuple[epub.EpubItem, Optional[str]]]):
+        """Yield (item, chapter_title, base_href, items) in spine order, parsing documents in worker processes when possible."""
+        workers = min(self.config.max_workers or min(8, os.cpu_count() or 1), len(documents))
+        parse_locally = self.content_processor.extract_document_items
+        if workers <= 1:
+            for item, chapter_title in documents:
+                base_href = urllib.parse.unquote(item.get_name())
+                yield item, chapter_title, base_href, parse_locally(item.get_content(), base_href, self.config)
             return
-        if not self.content_processor.structured_content:
-             self.logger.warning("Structured content list is empty. XML file will be minimal.")
 
-        try:
-            self.logger.info("Bắt đầu tạo file XML từ dữ liệu cấu trúc...")
-            root = ET.Element("lightnovel")
-            current_chapter_element = None
-            chapter_count = 0
-            paragraph_count = 0
-            image_count = 0
-            default_chapter_id_val = "ch_frontmatter"
-            default_chapter_title_val = "Front Matter"
-
-            # --- Metadata block (remains commented out) ---
-            # self.extract_metadata() # Call if needed, but don't add to XML per spec
-
-            for item in self.content_processor.structured_content:
-                item_type = item.get("type")
-                self.logger.debug(f"Processing structured item for XML: Type='{item_type}'")
-
-                if item_type == "chapter_start":
-                    chapter_count += 1
-                    current_chapter_element = ET.SubElement(
-                        root, "chapter", id=f"ch{chapter_count}",
-                        title=item.get("title", "Untitled Chapter")
-                    )
-                    self.logger.debug(f"  Created XML chapter: id='ch{chapter_count}', title='{item.get('title', 'Untitled')}'")
-
-                elif item_type == "paragraph":
-                    if current_chapter_element is None:
-                        # Attempt to find or create a default chapter for orphan content
-                        found_default_chapter = root.find(f".//chapter[@id='{default_chapter_id_val}']")
-                        if found_default_chapter is not None:
-                            current_chapter_element = found_default_chapter
-                        else:
-                            self.logger.info(f"Paragraph found before any main chapter. Creating '{default_chapter_title_val}' chapter (ID: {default_chapter_id_val}).")
-                            current_chapter_element = ET.SubElement(
-                                root, "chapter",
-                                id=default_chapter_id_val,
-                                title=default_chapter_title_val
-                            )
-                    
-                    paragraph_count += 1
-                    para_elem = ET.SubElement(
-                        current_chapter_element, "paragraph",
-                        id=f"p{paragraph_count}", translate="yes"
-                    )
-                    if item.get("role"):
-                        para_elem.set("role", item["role"])
-                    text_elem = ET.SubElement(para_elem, "text")
-                    text_elem.text = item.get("text", "")
-                    self.logger.debug(f"  Added XML paragraph: id='p{paragraph_count}' to chapter {current_chapter_element.get('id')}")
-
-                elif item_type == "image":
-                    if current_chapter_element is None:
-                        # Attempt to find or create a default chapter for orphan content
-                        found_default_chapter = root.find(f".//chapter[@id='{default_chapter_id_val}']")
-                        if found_default_chapter is not None:
-                            current_chapter_element = found_default_chapter
-                        else:
-                            self.logger.info(f"Image found before any main chapter. Creating '{default_chapter_title_val}' chapter (ID: {default_chapter_id_val}).")
-                            current_chapter_element = ET.SubElement(
-                                root, "chapter",
-                                id=default_chapter_id_val,
-                                title=default_chapter_title_val
-                            )
-
-                    image_count += 1
-                    xml_file_path = self.base_dir / self.config.xml_filename
-                    image_file_path = Path(item['filepath'])
+        # Many EPUBs split a volume into hundreds of small XHTML files; sending them in chunks
+        # keeps the per-task IPC overhead from eating the parallel speed-up
+        chunksize = max(1, len(documents) // (workers * 4))
+        base_hrefs = [urllib.parse.unquote(item.get_name()) for item, _ in documents]
+        self.logger.info(f"Phân tích {len(documents)} tài liệu với {workers} tiến trình song song (chunksize={chunksize})...")
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.config,)) as executor:
+            # _process_doc never raises for a bad document, so a failure here means the pool itself broke
+            results = executor.map(_process_doc, [item.get_content() for item, _ in documents], base_hrefs,
+                                   chunksize=chunksize)
+            for (item, chapter_title), base_href in zip(documents, base_hrefs):
+                items = None
+                if results is not None:
                     try:
-                        relative_image_path = os.path.relpath(image_file_path, start=xml_file_path.parent)
-                        relative_image_path = relative_image_path.replace('\\', '/')
-                    except ValueError:
-                        self.logger.warning(f"Cannot create relative path for image {image_file_path} from {xml_file_path.parent}. Using default relative path.")
-                        relative_image_path = f"{self.config.image_dir}/{item.get('filename', 'unknown_image')}"
-                    ET.SubElement(
-                        current_chapter_element, "image", id=f"img{image_count}",
-                        src=relative_image_path, alt=item.get("alt", "Image")
-                    )
-                    self.logger.debug(f"  Added XML image: id='img{image_count}', src='{relative_image_path}' to chapter {current_chapter_element.get('id')}")
-                else:
-                     self.logger.warning(f"Unknown structured item type encountered: '{item_type}'. Skipping.")
+                        items, records = next(results)
+                        for level, message in records:
+                            self.logger.log(level, message)
+                    except Exception as e:
+                        self.logger.warning(f"Worker pool failed at {base_href}, parsing the remaining documents in-process: {e}")
+                        results = None
+                if items is None:
+                    items = parse_locally(item.get_content(), base_href, self.config)
+                yield item, chapter_title, base_href, items
 
-            self.logger.info("Generating final XML output string...")
-            xml_content_bytes = ET.tostring(root, encoding=self.config.output_encoding, method='xml')
-            try:
-                dom = minidom.parseString(xml_content_bytes)
-                pretty_xml_content = dom.toprettyxml(indent="  ", encoding=self.config.output_encoding)
-            except Exception as pretty_print_error:
-                 self.logger.warning(f"Không thể định dạng XML (pretty-print), đang lưu phiên bản thô: {pretty_print_error}")
-                 xml_declaration = f'<?xml version="1.0" encoding="{self.config.output_encoding}"?>\n'.encode(self.config.output_encoding)
-                 pretty_xml_content = xml_declaration + xml_content_bytes
-            xml_file = self.base_dir / self.config.xml_filename
-            with open(xml_file, 'wb') as f:
-                f.write(pretty_xml_content)
-            self.logger.info(f"Đã lưu thành công nội dung XML vào: {xml_file}")
-            self.save_image_log()
-        except Exception as e:
-            self.logger.error(f"Lỗi khi tạo hoặc lưu kết quả XML: {str(e)}", exc_info=True)
 
     def save_image_log(self):
         """Lưu log chi tiết về xử lý hình ảnh."""
-        if not self.image_processor.image_log:
+        if not self.image_processor.image_log_by_hash:
              self.logger.info("Không có hình ảnh nào được xử lý hoặc lưu, bỏ qua image log.")
              return
         log_file = self.base_dir / 'image_log.txt'
         try:
-            with open(log_file, 'w', encoding=self.config.output_encoding) as f:
+            entries = [IMAGE_LOG_ENTRY_TEMPLATE % (entry.get('filename', 'N/A'),
+                                                   entry.get('filepath', 'N/A'),
+                                                   entry.get('dimensions', 'N/A'),
+                                                   entry.get('source', 'N/A'),
+                                                   entry['hash'].hex() if 'hash' in entry else 'N/A')
+                       for entry in self.image_processor.image_log]
+            with open(log_file, 'w', encoding=self.config.output_encoding, buffering=1 << 20) as f:
                 f.write("="*20 + " Image Processing Log " + "="*20 + "\n\n")
-                for entry in self.image_processor.image_log:
-                    f.write(f"File:       {entry.get('filename', 'N/A')}\n")
-                    f.write(f"Saved Path: {entry.get('filepath', 'N/A')}\n")
-                    f.write(f"Dimensions: {entry.get('dimensions', 'N/A')}\n")
-                    f.write(f"Source Ctx: {entry.get('source', 'N/A')}\n")
-                    f.write(f"Hash:       {entry.get('hash', 'N/A')}\n")
-                    f.write("-" * 60 + "\n")
+                f.writelines(entries)
             self.logger.info(f"Image processing log đã được lưu vào: {log_file}")
         except Exception as e:
             self.logger.error(f"Lỗi khi lưu image log: {str(e)}")
@@ -726,17 +1225,31 @@ class EPUBProcessor:
         """Phương thức chính để xử lý EPUB"""
         try:
             self.logger.info(f"Đang xử lý EPUB: {self.epub_path}")
-            if not self.epub_path.exists():
+            try:
+                # read_epub loads every item into memory in one pass over the ZIP (or an extracted EPUB directory)
+                self.book = epub.read_epub(str(self.epub_path))
+            except FileNotFoundError:
                 self.logger.error(f"File EPUB không tồn tại: {self.epub_path}")
                 return False
-            self.book = epub.read_epub(str(self.epub_path))
-            self.content_processor = ContentProcessor(
-                self.book, self.image_processor, self.logger
-            )
+            self.href_index = self.build_href_index()
+            self.id_index = {item.get_id(): item for item in self.book.get_items()}
             self.extract_chapters()
-            self.extract_metadata() # Extract metadata, but it's not added to XML by default
-            self.process_content() # Populate structured_content list
-            self.save_results_xml() # Generate XML from structured_content
+            if self.config.include_metadata:
+                self.extract_metadata() # Logged only; metadata is not added to the XML
+            xml_file = self.base_dir / self.config.xml_filename
+            with XMLContentWriter(xml_file, self.config, self.logger, self.image_dir) as writer:
+                self.content_processor = ContentProcessor(
+                    self.book, self.image_processor, writer, self.logger, self.href_index
+                )
+                try:
+                    self.process_content() # Stream structured content straight into the XML file
+                finally:
+                    failed_images = self.image_processor.close() # Every referenced image file is complete before the XML is
+            self.logger.info(f"Đã lưu thành công nội dung XML vào: {xml_file}")
+            self.save_image_log()
+            if failed_images:
+                self.logger.error(f"{len(failed_images)} hình ảnh được tham chiếu trong XML nhưng không ghi được: {', '.join(failed_images)}")
+                return False
             self.logger.info("Xử lý EPUB hoàn tất thành công")
             return True
         except ebooklib.epub.EpubException as e:
@@ -1,14 +1,21 @@
 import os
 import sys
 import time
+import asyncio
+import math
 import threading
 import signal
 import json
+import sqlite3
+import hashlib
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
 import tiktoken
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, BadRequestError, NotFoundError, PermissionDeniedError, RateLimitError
+try:
+    from lxml import etree as LET # Optional: pretty-prints in C without a minidom reparse
+except ImportError:
+    LET = None
 
 # --- Configuration ---
 load_dotenv()
@@ -19,10 +26,22 @@ MAX_RETRIES = 3
 MIN_TOKEN_RATIO = 0.6 # Adjust as needed
 MAX_TOKEN_RATIO = 1.5 # Adjust as needed
 BATCH_SIZE = 70 # Number of text elements per API call
+MAX_CONCURRENCY = 4 # Batches in flight at once; 1 = one request at a time
+PROGRESS_SAVE_INTERVAL = 5 # Seconds between progress file saves while batches are running
+REQUESTS_PER_MINUTE = 20 # Request budget shared by all concurrent batches (OpenRouter free models allow 20/min); None = no request limit
+TOKENS_PER_MINUTE = None # Prompt + max_tokens budget per minute; None = no token limit
+RATE_LIMIT_COOLDOWN = 60 # Seconds the rates stay reduced after a 429 response
+MAX_BATCHES_PER_REQUEST = 1 # Opt-in: >1 lets up to this many batches share one request when REQUESTS_PER_MINUTE, not request latency, limits throughput
+USE_BATCH_API = False # Bulk pass through the OpenAI Batch API (half price, 24h window); not supported by OpenRouter
+BATCH_POLL_INTERVAL = 60 # Seconds between Batch API status checks
 CONTEXT_WINDOW = 15 # Number of previous translations to use as context
 OUTPUT_ENCODING = 'utf-8'
 PROGRESS_FILE_SUFFIX = '_progress.json'
 TRANSLATED_FILE_SUFFIX = '_translated.xml'
+BATCH_INPUT_FILE_SUFFIX = '_batch.jsonl'
+BATCH_JOB_FILE_SUFFIX = '_batch_job.json' # Id of the submitted Batch API job, so an interrupted run resumes polling it
+TEXT_CACHE_FILE = 'translation_cache.sqlite3' # (model, source text) -> translation, shared by every XML file in the same folder
+DEDUP_MIN_LENGTH = 30 # Same threshold as epub_to_xml's duplicate_min_length; shorter repeats are translated in context
 #RSE = "medium" # reasoning_effort, can be "low", "medium", "high", comment out if use non-google models
 
 PROMPT_TEMPLATE = """[IMPORTANT] Translate the following Japanese light novel text snippets into Vietnamese. Follow these instructions carefully:
@@ -64,35 +83,62 @@ Content to translate (each item on a new line, formatted as 'id: text_to_transla
 
 # --- Globals ---
 stop_flag = False
+XML_PARSE_ERRORS = (ET.ParseError,) + ((LET.XMLSyntaxError,) if LET is not None else ())
 
 # --- Helper Classes ---
-class TimerWithProgress:
-    def __init__(self):
-        self.start_time = 0
-        self.active = False
-        self.thread = None
-
-    def start(self):
-        self.active = True
-        self.start_time = time.time()
-
-        def display_progress():
-            while self.active:
-                elapsed = time.time() - self.start_time
-                sys.stdout.write(f"\rAPI Call Time: {elapsed:.1f}s")
-                sys.stdout.flush()
-                time.sleep(0.1)
-
-        self.thread = threading.Thread(target=display_progress, daemon=True)
-        self.thread.start()
-
-    def stop(self):
-        self.active = False
-        if self.thread:
-            self.thread.join()
-        sys.stdout.write("\r" + " " * 30 + "\r") # Clear the line
-        sys.stdout.flush()
-        return time.time() - self.start_time
+class RateLimiter:
+    """Token buckets for requests/min and tokens/min shared by all concurrent batches.
+    Requests wait for capacity before they are sent instead of discovering the limit through 429 responses."""
+    def __init__(self, requests_per_minute, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_request_capacity = float(requests_per_minute or 0)
+        self.available_token_capacity = float(tokens_per_minute or 0)
+        self.slowdown = 1.0 # Fraction of the configured rates currently allowed; halved on each 429
+        self.cooldown_until = 0.0
+        self.last_update = time.monotonic()
+        self.lock = asyncio.Lock() # Waiters are served in order, so a big batch can't be starved by small ones
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.slowdown < 1.0 and now >= self.cooldown_until:
+            self.slowdown = 1.0
+        elapsed = now - self.last_update
+        self.last_update = now
+        if self.requests_per_minute:
+            self.available_request_capacity = min(
+                self.requests_per_minute,
+                self.available_request_capacity + elapsed * self.requests_per_minute * self.slowdown / 60)
+        if self.tokens_per_minute:
+            self.available_token_capacity = min(
+                self.tokens_per_minute,
+                self.available_token_capacity + elapsed * self.tokens_per_minute * self.slowdown / 60)
+
+    async def acquire(self, estimated_tokens):
+        """Wait until one request and estimated_tokens tokens are available, then take them"""
+        async with self.lock:
+            # A request larger than the whole token budget only has to wait for a full bucket
+            needed_tokens = min(estimated_tokens, self.tokens_per_minute) if self.tokens_per_minute else 0
+            while True:
+                self._refill()
+                missing_requests = 1 - self.available_request_capacity if self.requests_per_minute else 0
+                missing_tokens = needed_tokens - self.available_token_capacity if self.tokens_per_minute else 0
+                if missing_requests <= 0 and missing_tokens <= 0:
+                    if self.requests_per_minute:
+                        self.available_request_capacity -= 1
+                    if self.tokens_per_minute:
+                        self.available_token_capacity -= needed_tokens
+                    return
+                wait = max(missing_requests * 60 / (self.requests_per_minute * self.slowdown) if missing_requests > 0 else 0,
+                           missing_tokens * 60 / (self.tokens_per_minute * self.slowdown) if missing_tokens > 0 else 0)
+                await asyncio.sleep(wait)
+
+    def penalize(self):
+        """Back off after a 429: halve the allowed rates for RATE_LIMIT_COOLDOWN seconds and empty the request bucket"""
+        self._refill()
+        self.slowdown = max(0.125, self.slowdown / 2)
+        self.cooldown_until = time.monotonic() + RATE_LIMIT_COOLDOWN
+        self.available_request_capacity = min(self.available_request_capacity, 0.0)
 
 # --- Core Translator Class ---
 class XMLTranslator:
@@ -100,12 +146,16 @@ class XMLTranslator:
         self.input_xml_path = input_xml_path
         self.output_xml_path = self._generate_output_path(input_xml_path, TRANSLATED_FILE_SUFFIX)
         self.progress_file = self._generate_output_path(input_xml_path, PROGRESS_FILE_SUFFIX)
+        self.batch_input_file = self._generate_output_path(input_xml_path, BATCH_INPUT_FILE_SUFFIX)
+        self.batch_job_file = self._generate_output_path(input_xml_path, BATCH_JOB_FILE_SUFFIX)
+        self.text_cache_file = os.path.join(os.path.dirname(os.path.abspath(input_xml_path)), TEXT_CACHE_FILE)
 
         if not API_KEY:
             print("ERROR: API_KEY not found in environment variables or .env file.")
             sys.exit(1)
 
-        self.client = OpenAI(base_url=BASE_URL, api_key=API_KEY)
+        self.client = AsyncOpenAI(base_url=BASE_URL, api_key=API_KEY)
+        self.rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
         try:
             self.tokenizer = tiktoken.get_encoding("cl100k_base")
         except Exception as e:
@@ -114,8 +164,12 @@ class XMLTranslator:
 
         self.lock = threading.Lock()
         self.translation_cache = {}
-        self.context_lines = []
         self.elements_to_translate = []
+        self.progress_dirty = False # Set when the cache has translations not yet written to the progress file
+        self.text_db = None # Connection to TEXT_CACHE_FILE, opened by load_text_cache
+        self.pending_text_rows = [] # (key, translation) rows not yet written to the text cache
+        self.duplicate_ids = {} # Id sent to the API -> ids of later elements with the same source text
+        self.source_text_by_id = {}
 
     def _generate_output_path(self, base_path, suffix):
         base_name = os.path.splitext(base_path)[0]
@@ -123,6 +177,8 @@ class XMLTranslator:
 
     def _handle_interrupt(self, signum, frame):
         global stop_flag
+        if stop_flag: # Second Ctrl-C: stop without waiting for the requests in flight
+            raise KeyboardInterrupt
         print("\n-> Stop request received. Finishing current batch and saving progress...")
         stop_flag = True
 
@@ -148,11 +204,54 @@ class XMLTranslator:
             print("No progress file found. Starting fresh.")
             self.translation_cache = {}
 
+    def _text_key(self, source_text):
+        """Text cache key: the same source translated by another model is a different entry"""
+        return hashlib.sha1(f"{API_MODEL}\n{source_text}".encode('utf-8')).hexdigest()
+
+    def load_text_cache(self):
+        if self.text_db is not None:
+            return
+        try:
+            self.text_db = sqlite3.connect(self.text_cache_file)
+            # WAL lets a run on another volume read the cache while this one writes to it
+            self.text_db.execute("PRAGMA journal_mode=WAL")
+            self.text_db.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, text TEXT NOT NULL)")
+        except sqlite3.Error as e:
+            print(f"ERROR: Could not open text cache {self.text_cache_file}: {e}. Continuing without it.")
+            self.text_db = None
+
+    def close_text_cache(self):
+        """Close the text cache after the final save; closing the last connection also removes the -wal/-shm files"""
+        if self.text_db is not None:
+            self.text_db.close()
+            self.text_db = None
+
+    def lookup_text_cache(self, source_texts):
+        """Known translations for source_texts, as {source text: translation}"""
+        if self.text_db is None:
+            return {}
+        text_by_key = {self._text_key(text): text for text in source_texts}
+        keys = list(text_by_key)
+        found = {}
+        for i in range(0, len(keys), 500): # Stay under SQLite's bound-parameter limit
+            chunk = keys[i:i + 500]
+            rows = self.text_db.execute(
+                f"SELECT key, text FROM translations WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            for key, translation in rows:
+                found[text_by_key[key]] = translation
+        return found
+
     def save_progress(self):
         try:
             with self.lock:
                 with open(self.progress_file, 'w', encoding=OUTPUT_ENCODING) as f:
                     json.dump(self.translation_cache, f, ensure_ascii=False, indent=2)
+                if self.pending_text_rows and self.text_db is not None:
+                    # Only the new rows are written, unlike the progress file
+                    with self.text_db:
+                        self.text_db.executemany("INSERT OR REPLACE INTO translations (key, text) VALUES (?, ?)",
+                                                 self.pending_text_rows)
+                    self.pending_text_rows = []
                 # print(f"Progress saved to {self.progress_file}")
         except Exception as e:
             print(f"Error saving progress: {e}")
@@ -220,153 +319,344 @@ class XMLTranslator:
             if elem['id'] not in self.translation_cache
         ]
         print(f"Initially found {len(elements_to_process)} elements needing translation.")
+        try:
+            elements_to_process = self.deduplicate(elements_to_process)
+            processed_count_in_this_run = asyncio.run(self._translate_pending(elements_to_process))
+        finally:
+            self.save_progress() # Final save, also when a second Ctrl-C aborts the requests in flight
+            self.close_text_cache()
 
+        print(f"\nTranslation process finished or interrupted. Total new items processed in this run: {processed_count_in_this_run}.")
+
+    def deduplicate(self, elements_to_process):
+        """Fill elements whose source text this model translated before (text cache) and send each remaining text only once.
+        Later elements with the same text get the first one's translation in _add_translations."""
+        self.load_text_cache()
+        known = self.lookup_text_cache({elem['text'] for elem in elements_to_process if len(elem['text']) >= DEDUP_MIN_LENGTH})
+        self.source_text_by_id = {elem['id']: elem['text'] for elem in elements_to_process}
+        self.duplicate_ids = {}
+        first_id_by_text = {}
+        unique_elements = []
+        reused = 0
+        for elem in elements_to_process:
+            text = elem['text']
+            if len(text) < DEDUP_MIN_LENGTH:
+                unique_elements.append(elem)
+            elif text in known:
+                self.translation_cache[elem['id']] = known[text]
+                reused += 1
+            elif text in first_id_by_text:
+                self.duplicate_ids[first_id_by_text[text]].append(elem['id'])
+            else:
+                first_id_by_text[text] = elem['id']
+                self.duplicate_ids[elem['id']] = []
+                unique_elements.append(elem)
+        duplicates = sum(len(ids) for ids in self.duplicate_ids.values())
+        if reused or duplicates:
+            print(f"Reused {reused} translations from {TEXT_CACHE_FILE}; {duplicates} repeated texts will copy their first occurrence. "
+                  f"{len(unique_elements)} elements left to send.")
+        return unique_elements
+
+    async def _translate_pending(self, elements_to_process):
+        """Translate the pending elements, up to MAX_CONCURRENCY batches at a time. Returns the number of new translations."""
+        # Position of every element in document order, so each batch can take the translations just before it as context
+        position = {elem['id']: index for index, elem in enumerate(self.elements_to_translate)}
+        semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        saver = asyncio.create_task(self._autosave_progress())
         processed_count_in_this_run = 0
-        batch_num_overall = 0 # For print statements
         original_total_to_translate = len(elements_to_process) # For percentage calculation relative to start of this run
-
-        while elements_to_process and not stop_flag: # Loop while there are items and no stop signal
-            batch_num_overall += 1
-            current_batch_size = min(len(elements_to_process), BATCH_SIZE)
-            batch = elements_to_process[:current_batch_size]
-
-            if not batch: # Should ideally not be reached if elements_to_process is not empty
-                break
-
+        round_num = 0
+        try:
+            if USE_BATCH_API and elements_to_process:
+                processed_count_in_this_run += await self.translate_with_batch_api(elements_to_process, position)
+                # Chat calls only for whatever the batch job did not translate
+                elements_to_process = [
+                    elem for elem in elements_to_process
+                    if elem['id'] not in self.translation_cache
+                ]
+            while elements_to_process and not stop_flag: # Each round retries whatever the previous round left untranslated
+                round_num += 1
+                request_size = BATCH_SIZE * self._batches_per_request(elements_to_process)
+                batches = [elements_to_process[i:i + request_size] for i in range(0, len(elements_to_process), request_size)]
+                print(f"\nRound {round_num}: {len(elements_to_process)} of {original_total_to_translate} elements remaining, "
+                      f"{len(batches)} batches, up to {MAX_CONCURRENCY} in flight.")
+                added_counts = await asyncio.gather(*(
+                    self._run_batch(semaphore, batch_num, batch, position)
+                    for batch_num, batch in enumerate(batches, start=1)
+                ))
+                added_this_round = sum(added_counts)
+                processed_count_in_this_run += added_this_round
+
+                # Update elements_to_process: remove items that are now in the main cache
+                elements_to_process = [
+                    elem for elem in elements_to_process
+                    if elem['id'] not in self.translation_cache
+                ]
+
+                if not elements_to_process:
+                    print("All elements processed, queue is now empty.")
+                elif stop_flag:
+                    print("Batch processing interrupted by stop_flag.")
+                elif not added_this_round:
+                    # Retrying straight away would only hammer the API; the next run picks these up from the progress file
+                    print(f"Warning: No new translations in round {round_num}. {len(elements_to_process)} elements left untranslated; run again to retry.")
+                    break
+        finally:
+            saver.cancel()
+        return processed_count_in_this_run
+
+    async def _autosave_progress(self):
+        """Single background writer for the progress file, so concurrent batches never save it themselves"""
+        while True:
+            await asyncio.sleep(PROGRESS_SAVE_INTERVAL)
+            if self.progress_dirty:
+                self.progress_dirty = False
+                self.save_progress()
+
+    async def _run_batch(self, semaphore, batch_num, batch, position):
+        """Translate one batch once a concurrency slot is free and add the results to the cache. Returns the number of new translations."""
+        async with semaphore:
+            if stop_flag:
+                return 0
             batch_ids = [elem['id'] for elem in batch]
             batch_texts_with_ids = [f"{elem['id']}: {elem['text']}" for elem in batch]
-            
-            # --- Progress Print Statement ---
-            current_progress_count = original_total_to_translate - len(elements_to_process)
-            print(f"\nProcessing batch {batch_num_overall}: "
-                  f"Attempting {len(batch)} elements (approx items {current_progress_count + 1} to {current_progress_count + len(batch)} of {original_total_to_translate} initial). "
-                  f"Remaining in queue: {len(elements_to_process)}. Starting ID: {batch_ids[0] if batch_ids else 'N/A'}")
-            # --- End Progress Print Statement ---
-
-            translations_tuple = self.process_batch(batch_texts_with_ids, batch_ids)
-            translations, is_complete = translations_tuple if translations_tuple else (None, False)
-
-            successfully_translated_ids_in_this_batch = set()
-
-            if translations:
-                with self.lock:
-                    for elem_id, translation_text in translations:
-                        if translation_text and translation_text.strip():
-                            if elem_id not in self.translation_cache: # Only count and cache if new
-                                self.translation_cache[elem_id] = translation_text
-                                successfully_translated_ids_in_this_batch.add(elem_id)
-                        else:
-                            print(f"   Warning: Skipping empty translation received for ID: {elem_id}")
-                
-                if successfully_translated_ids_in_this_batch:
-                    processed_count_in_this_run += len(successfully_translated_ids_in_this_batch)
-                    self.save_progress() # Save after successful new translations in batch
-
-                num_returned_translations = len(translations)
-                
-                if is_complete:
-                    print(f"Batch translated. API returned {num_returned_translations} translations. Added {len(successfully_translated_ids_in_this_batch)} new items to cache. Processed in this run: {processed_count_in_this_run}. Total in cache: {len(self.translation_cache)}. Progress saved.")
-                else: # Partial success or mismatch from API perspective
-                    print(f"Warning: Processed partial batch. API returned {num_returned_translations} translations for {len(batch)} sent items. Added {len(successfully_translated_ids_in_this_batch)} new items to cache. Processed in this run: {processed_count_in_this_run}. Total in cache: {len(self.translation_cache)}. Progress saved. Unreturned/mismatched items will be re-attempted if still pending.")
-
-            elif stop_flag:
-                 print("Batch processing interrupted by stop_flag.")
-                 break 
-            else: # Batch failed completely (process_batch returned None, False)
-                print(f"Warning: Batch failed completely after retries (starting with original ID: {batch[0]['id'] if batch else 'N/A'}). These {len(batch)} items will remain in queue for the next attempt.")
-
-            # Update elements_to_process: remove items that are now in the main cache
-            elements_to_process = [
-                elem for elem in elements_to_process
-                if elem['id'] not in self.translation_cache
-            ]
-            
-            if not elements_to_process:
-                print("All elements processed, or no new elements were translated in the last batch and queue is now empty.")
-                break
-            
-            # Optional: Add a small delay if API calls are rapid and failing, to prevent hammering
-            # if not translations and not stop_flag and not successfully_translated_ids_in_this_batch:
-            #     print("Pausing briefly after a batch yielded no new translations...")
-            #     time.sleep(REQUEST_DELAY_ON_FAIL) # Define REQUEST_DELAY_ON_FAIL, e.g., 5 seconds
 
-        print(f"\nTranslation process finished or interrupted. Total new items processed in this run: {processed_count_in_this_run}.")
-        self.save_progress() # Final save
+            context_lines = self._context_before(batch_ids[0], position)
+
+            print(f"\nBatch {batch_num}: Attempting {len(batch)} elements. Starting ID: {batch_ids[0]}")
+            translations, is_complete = await self.process_batch(batch_texts_with_ids, batch_ids, context_lines, batch_num)
+
+        if not translations:
+            if not stop_flag: # Batch failed completely (process_batch returned None, False)
+                print(f"Warning: Batch {batch_num} failed completely after retries (starting with original ID: {batch_ids[0]}). These {len(batch)} items will remain in queue for the next attempt.")
+            return 0
+
+        successfully_translated_ids_in_this_batch = self._add_translations(translations)
+
+        num_returned_translations = len(translations)
+        if is_complete:
+            print(f"Batch {batch_num} translated. API returned {num_returned_translations} translations. Added {len(successfully_translated_ids_in_this_batch)} new items to cache. Total in cache: {len(self.translation_cache)}.")
+        else: # Partial success or mismatch from API perspective
+            print(f"Warning: Batch {batch_num} processed partially. API returned {num_returned_translations} translations for {len(batch)} sent items. Added {len(successfully_translated_ids_in_this_batch)} new items to cache. Total in cache: {len(self.translation_cache)}. Unreturned/mismatched items will be re-attempted if still pending.")
+        return len(successfully_translated_ids_in_this_batch)
+
+    def _batches_per_request(self, elements_to_process):
+        """How many BATCH_SIZE batches to send per request. Ids keep every item's answer separate, so packing
+        batches is only a bigger prompt; it pays off when the request budget, not the token budget, runs out first."""
+        batch_count = math.ceil(len(elements_to_process) / BATCH_SIZE)
+        if MAX_BATCHES_PER_REQUEST <= 1 or not REQUESTS_PER_MINUTE or batch_count <= REQUESTS_PER_MINUTE:
+            return 1 # Everything fits in one minute of requests anyway
+        packed = min(MAX_BATCHES_PER_REQUEST, math.ceil(batch_count / REQUESTS_PER_MINUTE))
+        if TOKENS_PER_MINUTE:
+            # Stay within the tokens one request may use if requests are spread evenly over the minute
+            source_text = "\n".join(elem['text'] for elem in elements_to_process)
+            source_tokens = len(self.tokenizer.encode(source_text)) if self.tokenizer else len(source_text.split())
+            batch_tokens = source_tokens / batch_count * (1 + MAX_TOKEN_RATIO * 1.2)
+            packed = min(packed, max(1, int(TOKENS_PER_MINUTE / REQUESTS_PER_MINUTE // batch_tokens)))
+        if packed > 1:
+            print(f"Request-rate bound ({batch_count} batches at {REQUESTS_PER_MINUTE} requests/min): sending {packed} batches per request.")
+        return packed
+
+    def _context_before(self, first_id, position):
+        """Translations already known for the CONTEXT_WINDOW elements right before first_id"""
+        first_index = position[first_id]
+        return [
+            self.translation_cache[elem['id']]
+            for elem in self.elements_to_translate[max(0, first_index - CONTEXT_WINDOW):first_index]
+            if elem['id'] in self.translation_cache
+        ]
 
-    def process_batch(self, batch_texts_with_ids, original_batch_ids): # original_batch_ids for error reporting if needed
-        timer = TimerWithProgress()
-        # best_result_lines = None # These variables seem unused
-        # best_avg_ratio = -1
+    def _add_translations(self, translations):
+        """Put new (id, text) pairs into the cache; returns the set of ids that were added"""
+        added_ids = set()
+        with self.lock:
+            for elem_id, translation_text in translations:
+                if translation_text and translation_text.strip():
+                    if elem_id not in self.translation_cache: # Only count and cache if new
+                        self.translation_cache[elem_id] = translation_text
+                        added_ids.add(elem_id)
+                        for duplicate_id in self.duplicate_ids.get(elem_id, ()):
+                            self.translation_cache.setdefault(duplicate_id, translation_text)
+                        source_text = self.source_text_by_id.get(elem_id)
+                        if source_text is not None and len(source_text) >= DEDUP_MIN_LENGTH:
+                            self.pending_text_rows.append((self._text_key(source_text), translation_text))
+                else:
+                    print(f"   Warning: Skipping empty translation received for ID: {elem_id}")
+        if added_ids:
+            self.progress_dirty = True
+        return added_ids
 
-        # Prepare content for prompt
+    def build_request(self, batch_texts_with_ids, context_lines):
+        """Prompt, source token count and max_tokens for one batch"""
         content_to_translate = "\n".join(batch_texts_with_ids)
-
-        # Prepare context
-        context_str = "\n".join(self.context_lines[-CONTEXT_WINDOW:])
-
+        context_str = "\n".join(context_lines[-CONTEXT_WINDOW:])
         prompt = PROMPT_TEMPLATE.format(
             context=context_str if context_str else "N/A",
             content=content_to_translate
         )
-
         src_tokens = len(self.tokenizer.encode(content_to_translate)) if self.tokenizer else len(content_to_translate.split())
+        # max_tokens can be tricky; estimate based on source length + buffer
+        max_tokens = max(150 * len(batch_texts_with_ids), int(src_tokens * MAX_TOKEN_RATIO * 1.2) + 50)
+        return prompt, src_tokens, max_tokens
+
+    def parse_translations(self, result):
+        """Split an 'id: translated text' response into (id, text) pairs; returns (pairs, malformed line count)"""
+        parsed_translations = [] # List of (id, text) tuples
+        malformed_lines = 0
+        for line in result.split('\n'):
+            if not line.strip(): # Skip empty lines from API response
+                continue
+            try:
+                # Expecting format "id: translated text"
+                parts = line.split(':', 1)
+                if len(parts) == 2:
+                    parsed_translations.append((parts[0].strip(), parts[1].strip()))
+                else:
+                    # Line doesn't match "id: text" format
+                    print(f"   Warning: Malformed translation line (no colon or unexpected format): '{line[:100]}...' Skipping.")
+                    malformed_lines += 1
+            except Exception as e:
+                print(f"   Error parsing translation line '{line[:100]}...': {e}. Skipping.")
+                malformed_lines += 1
+        return parsed_translations, malformed_lines
+
+    def _clear_batch_job(self):
+        for finished_file in (self.batch_job_file, self.batch_input_file):
+            if os.path.exists(finished_file):
+                os.remove(finished_file)
+
+    async def translate_with_batch_api(self, elements_to_process, position):
+        """Bulk pass: send every batch as one Batch API job, wait for it and cache the results.
+        Returns the number of new translations; anything the job misses is left for the chat path."""
+        job_id = None
+        if os.path.exists(self.batch_job_file):
+            try:
+                with open(self.batch_job_file, 'r', encoding=OUTPUT_ENCODING) as f:
+                    job_id = json.load(f)['batch_id']
+                print(f"Resuming Batch API job {job_id} from {self.batch_job_file}.")
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Warning: Could not read {self.batch_job_file} ({e}). Submitting a new Batch API job.")
+
+        try:
+            if job_id is None:
+                batches = [elements_to_process[i:i + BATCH_SIZE] for i in range(0, len(elements_to_process), BATCH_SIZE)]
+                with open(self.batch_input_file, 'w', encoding=OUTPUT_ENCODING) as f:
+                    for batch_num, batch in enumerate(batches, start=1):
+                        batch_texts_with_ids = [f"{elem['id']}: {elem['text']}" for elem in batch]
+                        prompt, _, max_tokens = self.build_request(batch_texts_with_ids, self._context_before(batch[0]['id'], position))
+                        request = {
+                            "custom_id": f"batch_{batch_num}",
+                            "method": "POST",
+                            "url": "/v1/chat/completions",
+                            "body": {"model": API_MODEL, "messages": [{"role": "user", "content": prompt}], "max_tokens": max_tokens},
+                        }
+                        f.write(json.dumps(request, ensure_ascii=False) + "\n")
+                with open(self.batch_input_file, 'rb') as f:
+                    input_file = await self.client.files.create(file=f, purpose="batch")
+                job = await self.client.batches.create(
+                    input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+                job_id = job.id
+                with open(self.batch_job_file, 'w', encoding=OUTPUT_ENCODING) as f:
+                    json.dump({'batch_id': job_id}, f)
+                print(f"Submitted Batch API job {job_id} with {len(batches)} batches ({len(elements_to_process)} elements).")
+
+            while True:
+                job = await self.client.batches.retrieve(job_id)
+                if job.status in ('completed', 'failed', 'expired', 'cancelled'):
+                    break
+                if stop_flag:
+                    print(f"Stopped while waiting for Batch API job {job_id}. Run again to resume it.")
+                    return 0
+                counts = job.request_counts
+                done = f" ({counts.completed}/{counts.total} done)" if counts else ""
+                print(f"Batch API job {job_id}: {job.status}{done}. Checking again in {BATCH_POLL_INTERVAL}s...")
+                await asyncio.sleep(BATCH_POLL_INTERVAL)
+        except Exception as e:
+            print(f"Warning: Batch API unavailable ({type(e).__name__}: {e}). Falling back to chat requests.")
+            if job_id is not None and isinstance(e, (NotFoundError, BadRequestError, PermissionDeniedError)):
+                # Deleted, expired or another key's job: resuming it would fail the same way on every run
+                print(f"Forgetting Batch API job {job_id}; the next run submits a new one.")
+                self._clear_batch_job()
+            return 0
+
+        added_count = 0
+        try:
+            if job.status == 'completed' and job.output_file_id:
+                output = await self.client.files.content(job.output_file_id)
+                for line in output.text.splitlines():
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                        response = record.get('response') or {}
+                        if response.get('status_code') != 200:
+                            print(f"   Warning: Batch API request {record.get('custom_id')} failed: {record.get('error') or response.get('status_code')}")
+                            continue
+                        choices = (response.get('body') or {}).get('choices') or []
+                        result = (choices[0]['message'].get('content') or '').strip() if choices else ''
+                    except (ValueError, AttributeError, KeyError, IndexError, TypeError) as e:
+                        print(f"   Warning: Skipping malformed Batch API output line ({type(e).__name__}: {e}): '{line[:100]}...'")
+                        continue
+                    translations, _ = self.parse_translations(result)
+                    added_count += len(self._add_translations(translations))
+                print(f"Batch API job {job_id} completed. Added {added_count} new items to cache.")
+            else:
+                print(f"Warning: Batch API job {job_id} ended with status '{job.status}'. Falling back to chat requests.")
+                for error in getattr(job.errors, 'data', None) or []: # Why the job itself was rejected (e.g. invalid input file)
+                    print(f"   {error.code}: {error.message}")
+            if job.error_file_id:
+                # Requests that failed inside the job are listed here, not in the output file
+                errors = await self.client.files.content(job.error_file_id)
+                error_lines = [line for line in errors.text.splitlines() if line.strip()]
+                print(f"Warning: {len(error_lines)} requests of Batch API job {job_id} failed; they will be sent as chat requests.")
+                for line in error_lines[:5]:
+                    print(f"   {line[:200]}")
+        except Exception as e:
+            print(f"Warning: Could not read the results of Batch API job {job_id} ({type(e).__name__}: {e}). Falling back to chat requests.")
+        finally:
+            # The job is finished either way; the next run must not resume it
+            self._clear_batch_job()
+        self.save_progress()
+        return added_count
+
+    async def process_batch(self, batch_texts_with_ids, original_batch_ids, context_lines, batch_num): # original_batch_ids for error reporting if needed
+        prompt, src_tokens, max_tokens = self.build_request(batch_texts_with_ids, context_lines)
+        content_to_translate = "\n".join(batch_texts_with_ids) # For error reporting
+        estimated_tokens = 0
+        if TOKENS_PER_MINUTE: # Providers count the whole prompt plus max_tokens against the token limit
+            estimated_tokens = (len(self.tokenizer.encode(prompt)) if self.tokenizer else len(prompt.split())) + max_tokens
 
         for attempt in range(MAX_RETRIES):
             if stop_flag:
                 return None, False # Interrupted
+            await self.rate_limiter.acquire(estimated_tokens)
+            start_time = time.monotonic()
             try:
-                timer.start()
-                response = self.client.chat.completions.create(
+                response = await self.client.chat.completions.create(
                     model=API_MODEL,
                     messages=[{"role": "user", "content": prompt}],
                     #temperature=0.3,
-                    # max_tokens can be tricky; estimate based on source length + buffer
-                    max_tokens=max(150 * len(batch_texts_with_ids), int(src_tokens * MAX_TOKEN_RATIO * 1.2) + 50),
+                    max_tokens=max_tokens,
                     # extra_body={ # Add Gemini-specific parameters here
                     #     "reasoning_effort": RSE  # Or "medium", "high" as needed
                     # }
                 )
-                elapsed = timer.stop() # Stop timer regardless of content validity
+                elapsed = time.monotonic() - start_time # Measured regardless of content validity
 
                 # --- Check for valid content before stripping ---
                 if response.choices and response.choices[0].message and response.choices[0].message.content is not None:
                     result = response.choices[0].message.content.strip()
                 else:
                     # Handle the case where content is None - THIS SHOULD RETRY
-                    print(f"\n   Attempt {attempt + 1}/{MAX_RETRIES}: Failed - API returned None content. Retrying...")
-                    time.sleep(2 ** attempt) # Exponential backoff
+                    print(f"\n   Batch {batch_num} attempt {attempt + 1}/{MAX_RETRIES}: Failed - API returned None content. Retrying...")
+                    await asyncio.sleep(2 ** attempt) # Exponential backoff; other batches keep running meanwhile
                     continue # Go to the next attempt
 
-                raw_result_lines = result.split('\n')
-                parsed_translations = [] # List of (id, text) tuples
-                malformed_lines = 0
-
-                for line in raw_result_lines:
-                    if not line.strip(): # Skip empty lines from API response
-                        continue
-                    try:
-                        # Expecting format "id: translated text"
-                        parts = line.split(':', 1)
-                        if len(parts) == 2:
-                            elem_id = parts[0].strip()
-                            translated_text = parts[1].strip()
-                            # Optional: Validate if elem_id is one of the sent IDs, though this adds complexity
-                            # if elem_id in original_batch_ids: # original_batch_ids was passed to process_batch
-                            parsed_translations.append((elem_id, translated_text))
-                            # else:
-                            #     print(f"   Warning: Received unexpected ID '{elem_id}' from API. Skipping.")
-                            #     malformed_lines +=1
-                        else:
-                            # Line doesn't match "id: text" format
-                            print(f"   Warning: Malformed translation line (no colon or unexpected format): '{line[:100]}...' Skipping.")
-                            malformed_lines += 1
-                    except Exception as e:
-                        print(f"   Error parsing translation line '{line[:100]}...': {e}. Skipping.")
-                        malformed_lines += 1
+                parsed_translations, malformed_lines = self.parse_translations(result)
 
                 if not parsed_translations and result: # No valid ID:text pairs parsed, but got some result
-                    print(f"\n   Attempt {attempt + 1}/{MAX_RETRIES}: Failed - No valid 'id: text' lines parsed from API response. Response: {result[:200]}... Retrying...")
-                    time.sleep(2 ** attempt)
+                    print(f"\n   Batch {batch_num} attempt {attempt + 1}/{MAX_RETRIES}: Failed - No valid 'id: text' lines parsed from API response. Response: {result[:200]}... Retrying...")
+                    await asyncio.sleep(2 ** attempt)
                     continue
 
                 # Check if the number of *parsed valid translations* matches the number of *sent items*
@@ -376,27 +666,25 @@ class XMLTranslator:
                     trans_tokens = len(self.tokenizer.encode(result)) if self.tokenizer else len(result.split())
                     avg_ratio = (trans_tokens / src_tokens) if src_tokens else 0
                     status_message = "Success!" if is_complete_match else "Partial Success - ID/Line count mismatch."
-                    print(f"   Attempt {attempt + 1}/{MAX_RETRIES}: {status_message} Time: {elapsed:.1f}s, Avg Ratio: {avg_ratio:.2f}")
+                    print(f"   Batch {batch_num} attempt {attempt + 1}/{MAX_RETRIES}: {status_message} Time: {elapsed:.1f}s, Avg Ratio: {avg_ratio:.2f}")
                     print(f"    Sent {len(batch_texts_with_ids)} items, received and parsed {len(parsed_translations)} valid 'id: text' translations.")
                     if malformed_lines > 0:
                         print(f"    Additionally, {malformed_lines} lines from API were malformed or skipped.")
 
-                    # Update context with the text part of new translations
-                    self.context_lines.extend([t[1] for t in parsed_translations])
-                    self.context_lines = self.context_lines[-CONTEXT_WINDOW*2:]
                     return parsed_translations, is_complete_match
                 else: # No translations parsed, and it wasn't caught by 'if not parsed_translations and result:' (e.g. API returned only whitespace)
-                    print(f"\n   Attempt {attempt + 1}/{MAX_RETRIES}: Failed - API returned empty or unparseable result. Retrying...")
-                    time.sleep(2 ** attempt)
+                    print(f"\n   Batch {batch_num} attempt {attempt + 1}/{MAX_RETRIES}: Failed - API returned empty or unparseable result. Retrying...")
+                    await asyncio.sleep(2 ** attempt)
                     continue
 
             except Exception as e: # API errors (including 429) or other issues - THIS SHOULD RETRY
-                elapsed = timer.stop() # Ensure timer stops on exception too
+                elapsed = time.monotonic() - start_time
+                if isinstance(e, RateLimitError):
+                    self.rate_limiter.penalize() # Every batch slows down, not just this one
                 # --- Enhanced Error Logging ---
-                import traceback
                 error_type = type(e).__name__
-                print(f"\n   Attempt {attempt + 1}/{MAX_RETRIES}: API Error ({elapsed:.1f}s): {error_type} - {e}")
-                # print(f"   Traceback: {traceback.format_exc()}") # Uncomment for detailed debugging
+                print(f"\n   Batch {batch_num} attempt {attempt + 1}/{MAX_RETRIES}: API Error ({elapsed:.1f}s): {error_type} - {e}")
+                # print(f"   Traceback: {traceback.format_exc()}") # Uncomment (and import traceback) for detailed debugging
                 # Log details about the batch that failed
                 print(f"   Failed Batch Content (first 100 chars): {content_to_translate[:100]}...")
                 # --- End Enhanced Error Logging ---
@@ -407,7 +695,7 @@ class XMLTranslator:
                     return None, False # Failed after retries
                 wait_time = 2 ** attempt + 1
                 print(f"   Retrying in {wait_time} seconds...")
-                time.sleep(wait_time) # Exponential backoff
+                await asyncio.sleep(wait_time) # Exponential backoff
                 # Implicitly continues to the next attempt via the loop
 
         return None, False # Failed all retries
@@ -415,7 +703,11 @@ class XMLTranslator:
     def rebuild_xml(self):
         print(f"\nRebuilding XML with translations from cache ({len(self.translation_cache)} entries)...")
         try:
-            tree = ET.parse(self.input_xml_path)
+            if LET is not None:
+                # Drop the input's indentation so pretty_print can re-indent the output cleanly
+                tree = LET.parse(self.input_xml_path, LET.XMLParser(remove_blank_text=True))
+            else:
+                tree = ET.parse(self.input_xml_path)
             root = tree.getroot()
             missing_translations = 0
 
@@ -441,28 +733,33 @@ class XMLTranslator:
                             print(f"Warning: Missing translation for paragraph ID: {para_id}")
                             missing_translations += 1
 
+                # Repeated paragraphs (translate="no" duplicate_of="pN") reuse the first occurrence's translation
+                for elem in chapter.findall('.//paragraph[@duplicate_of]'):
+                    text_elem = elem.find('text')
+                    original_id = elem.get('duplicate_of')
+                    if text_elem is not None and original_id in self.translation_cache:
+                        text_elem.text = self.translation_cache[original_id]
+
             if missing_translations > 0:
                 print(f"Warning: {missing_translations} elements marked for translation were not found in the cache.")
 
             # Save the modified tree
-            xml_content_bytes = ET.tostring(root, encoding=OUTPUT_ENCODING, method='xml')
-            try:
-                # Pretty print using minidom
-                dom = minidom.parseString(xml_content_bytes)
-                pretty_xml_content = dom.toprettyxml(indent="  ", encoding=OUTPUT_ENCODING)
-            except Exception as pretty_print_error:
-                 print(f"Warning: Could not pretty-print XML, saving raw version: {pretty_print_error}")
-                 # Add XML declaration manually if pretty-printing fails
-                 xml_declaration = f'<?xml version="1.0" encoding="{OUTPUT_ENCODING}"?>\n'.encode(OUTPUT_ENCODING)
-                 pretty_xml_content = xml_declaration + xml_content_bytes
-
-            with open(self.output_xml_path, 'wb') as f:
-                f.write(pretty_xml_content)
+            if LET is not None:
+                pretty_xml_content = LET.tostring(root, pretty_print=True, xml_declaration=True, encoding=OUTPUT_ENCODING)
+                with open(self.output_xml_path, 'wb') as f:
+                    f.write(pretty_xml_content)
+            else:
+                try:
+                    # Re-indent in place; no second DOM from a minidom reparse
+                    ET.indent(root, space="  ")
+                except Exception as pretty_print_error:
+                     print(f"Warning: Could not pretty-print XML, saving raw version: {pretty_print_error}")
+                tree.write(self.output_xml_path, encoding=OUTPUT_ENCODING, xml_declaration=True, method='xml')
 
             print(f"Successfully rebuilt and saved translated XML to: {self.output_xml_path}")
             return True
 
-        except ET.ParseError as e:
+        except XML_PARSE_ERRORS as e:
             print(f"Error parsing original XML file during rebuild: {e}")
             return False
         except Exception as e:
@@ -470,6 +767,8 @@ class XMLTranslator:
             return False
 
     def run(self):
+        # Ctrl-C sets stop_flag: running batches finish and their translations are saved before exiting
+        signal.signal(signal.SIGINT, self._handle_interrupt)
         if not self.extract_translatable_elements():
             return
         self.translate_elements()
@@ -3,6 +3,7 @@ from ebooklib import epub
 from bs4 import BeautifulSoup
 import os
 import base64
+import mimetypes
 from pathlib import Path
 import logging
 
@@ -10,6 +11,11 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+def image_media_type(image_path):
+    """Media type for an image file, e.g. image/svg+xml for .svg (not image/svg)"""
+    media_type, _ = mimetypes.guess_type(image_path.name)
+    return media_type or f'image/{image_path.suffix.lstrip(".").lower()}'
+
 def create_epub_from_xml(xml_path, epub_path, output_dir):
     """Creates an EPUB file from a structured XML file."""
     logger.info(f"Starting EPUB creation from XML: {xml_path}")
@@ -53,7 +59,7 @@ def create_epub_from_xml(xml_path, epub_path, output_dir):
                     
                     # Determine image type and create EpubImage item
                     img_filename = cover_image_path_abs.name
-                    img_media_type = f'image/{cover_image_path_abs.suffix.lstrip(".")}' # e.g., image/jpeg
+                    img_media_type = image_media_type(cover_image_path_abs) # e.g., image/jpeg
                     
                     cover_item = epub.EpubImage(
                         uid='cover_image',
@@ -131,7 +137,7 @@ def create_epub_from_xml(xml_path, epub_path, output_dir):
                         try:
                             with open(img_path_abs, 'rb') as img_f:
                                 img_content = img_f.read()
-                            img_media_type = f'image/{img_path_abs.suffix.lstrip(".")}'
+                            img_media_type = image_media_type(img_path_abs)
                             img_item = epub.EpubImage(
                                 uid=f'img_{element.get("id", img_filename)}',
                                 file_name=img_epub_path,
@@ -0,0 +1,190 @@
+import logging
+import os
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+from io import BytesIO
+from pathlib import Path
+
+from ebooklib import epub
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+
+from epub_to_xml import (ContentProcessor, DocumentContext, ExtractorConfig, ImageItem, ImageProcessor,
+                         Paragraph, XMLContentWriter)
+from xml_to_epub import image_media_type
+
+LOGGER = logging.getLogger('test_epub_to_xml')
+# xml_to_epub configures the root logger on import; keep the processors' expected warnings out of the test output
+LOGGER.addHandler(logging.NullHandler())
+LOGGER.propagate = False
+
+SVG_DATA = b'<?xml version="1.0"?>\n<svg xmlns="http://www.w3.org/2000/svg" width="200" height="200"><rect width="200" height="200"/></svg>'
+
+
+def encode_image(size, image_format, mode='RGB'):
+    buffer = BytesIO()
+    Image.new(mode, size, 'red' if mode == 'RGB' else 128).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+class ExtractImageDataTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.item = epub.EpubItem(file_name='OEBPS/images/a.jpg', content=b'image bytes')
+        self.processor = ContentProcessor(None, ImageProcessor(Path(self.tmp.name), LOGGER), None, LOGGER,
+                                          href_index={'OEBPS/images/a.jpg': self.item})
+
+    def test_relative_href(self):
+        ctx = DocumentContext.from_href('OEBPS/text/ch1.xhtml')
+        result = self.processor.extract_image_data('../images/a.jpg', ctx)
+        self.assertIsNotNone(result)
+        self.assertEqual(result[0], b'image bytes')
+
+    def test_root_absolute_href(self):
+        ctx = DocumentContext.from_href('OEBPS/text/ch1.xhtml')
+        result = self.processor.extract_image_data('/OEBPS/images/a.jpg', ctx)
+        self.assertIsNotNone(result)
+        self.assertEqual(result[0], b'image bytes')
+
+
+class XMLContentWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.xml_file = Path(self.tmp.name) / 'content.xml'
+
+    def write(self, items, chapter='Chapter <1> & "Intro"', config=None):
+        config = config or ExtractorConfig(output_dir=self.tmp.name)
+        with XMLContentWriter(self.xml_file, config, LOGGER, Path(self.tmp.name) / 'images') as writer:
+            if chapter is not None:
+                writer.start_chapter(chapter)
+            for item in items:
+                writer.write_item(item)
+        return ET.parse(self.xml_file).getroot()
+
+    def test_structure_and_escaping(self):
+        root = self.write([
+            Paragraph('Tom & Jerry <3'),
+            Paragraph('Heading', 'h2'),
+            ImageItem('abc_300x400.jpg', 'Image from "cover" & <art>'),
+        ])
+        self.assertEqual(root.tag, 'lightnovel')
+        chapter = root.find('chapter')
+        self.assertEqual(chapter.get('id'), 'ch1')
+        self.assertEqual(chapter.get('title'), 'Chapter <1> & "Intro"')
+        paragraphs = chapter.findall('paragraph')
+        self.assertEqual([p.get('id') for p in paragraphs], ['p1', 'p2'])
+        self.assertEqual(paragraphs[0].findtext('text'), 'Tom & Jerry <3')
+        self.assertEqual(paragraphs[0].get('translate'), 'yes')
+        self.assertEqual(paragraphs[1].get('role'), 'h2')
+        image = chapter.find('image')
+        self.assertEqual(image.get('src'), 'images/abc_300x400.jpg')
+        self.assertEqual(image.get('alt'), 'Image from "cover" & <art>')
+
+    def test_front_matter_chapter_for_content_before_first_chapter(self):
+        root = self.write([Paragraph('Before any chapter')], chapter=None)
+        chapter = root.find('chapter')
+        self.assertEqual(chapter.get('id'), XMLContentWriter.DEFAULT_CHAPTER_ID)
+        self.assertEqual(chapter.find('paragraph').findtext('text'), 'Before any chapter')
+
+    def test_repeated_paragraphs_marked_as_duplicates(self):
+        long_text = 'A paragraph that is long enough to be deduplicated.'
+        root = self.write([Paragraph(long_text), Paragraph('Short.'), Paragraph(long_text), Paragraph('Short.')])
+        paragraphs = root.find('chapter').findall('paragraph')
+        self.assertEqual(paragraphs[2].get('translate'), 'no')
+        self.assertEqual(paragraphs[2].get('duplicate_of'), 'p1')
+        # Repeats shorter than duplicate_min_length are still translated in context
+        self.assertEqual(paragraphs[3].get('translate'), 'yes')
+        self.assertIsNone(paragraphs[3].get('duplicate_of'))
+
+    def test_duplicates_not_marked_when_disabled(self):
+        long_text = 'A paragraph that is long enough to be deduplicated.'
+        config = ExtractorConfig(output_dir=self.tmp.name, mark_duplicates=False)
+        root = self.write([Paragraph(long_text), Paragraph(long_text)], config=config)
+        self.assertEqual([p.get('translate') for p in root.iter('paragraph')], ['yes', 'yes'])
+
+
+class ImageProcessorSaveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.image_dir = Path(self.tmp.name) / 'images'
+        self.config = ExtractorConfig(output_dir=self.tmp.name, image_encode_workers=0)
+
+    def save(self, data, config=None):
+        processor = ImageProcessor(self.image_dir, LOGGER)
+        details = processor.save(data, 'test', config=config or self.config)
+        self.assertEqual(processor.close(), [])
+        return details
+
+    def test_large_image_scaled_down_to_max_size(self):
+        details = self.save(encode_image((3000, 1000), 'PNG'))
+        self.assertTrue(details['filename'].endswith('_2048x683.jpg'))
+        with Image.open(details['filepath']) as img:
+            self.assertEqual((img.format, img.size), ('JPEG', (2048, 683)))
+
+    def test_background_encoding(self):
+        config = ExtractorConfig(output_dir=self.tmp.name, image_encode_workers=2)
+        details = self.save(encode_image((300, 200), 'PNG', 'RGB'), config)
+        with Image.open(details['filepath']) as img:
+            self.assertEqual((img.format, img.size), ('JPEG', (300, 200)))
+
+    def test_small_image_skipped(self):
+        self.assertIsNone(self.save(encode_image((64, 64), 'PNG')))
+
+    def test_jpeg_passthrough_copies_bytes(self):
+        data = encode_image((300, 200), 'JPEG')
+        details = self.save(data)
+        self.assertEqual(Path(details['filepath']).read_bytes(), data)
+
+    def test_svg_copied_verbatim(self):
+        details = self.save(SVG_DATA)
+        self.assertTrue(details['filename'].endswith('.svg'))
+        self.assertEqual(Path(details['filepath']).read_bytes(), SVG_DATA)
+        self.assertEqual(image_media_type(Path(details['filepath'])), 'image/svg+xml')
+
+    def test_media_types_for_packing(self):
+        self.assertEqual(image_media_type(Path('a.jpg')), 'image/jpeg')
+        self.assertEqual(image_media_type(Path('a.png')), 'image/png')
+
+    def test_rerun_reuses_saved_file(self):
+        data = encode_image((300, 200), 'PNG')
+        first = self.save(data)
+        # Marker content: a rerun must register the existing file, not encode it again
+        Path(first['filepath']).write_bytes(b'saved by an earlier run')
+        second = self.save(data)
+        self.assertEqual(second['filename'], first['filename'])
+        self.assertEqual(Path(second['filepath']).read_bytes(), b'saved by an earlier run')
+
+    def test_rerun_with_other_size_limits_saves_new_file(self):
+        data = encode_image((300, 200), 'PNG')
+        first = self.save(data)
+        config = ExtractorConfig(output_dir=self.tmp.name, image_encode_workers=0,
+                                 max_image_width=150, max_image_height=150)
+        second = self.save(data, config)
+        self.assertNotEqual(second['filename'], first['filename'])
+        with Image.open(second['filepath']) as img:
+            self.assertEqual(img.size, (150, 100))
+
+    def test_no_partial_files_left(self):
+        self.save(encode_image((300, 200), 'PNG'))
+        self.save(SVG_DATA)
+        self.assertEqual([name for name in os.listdir(self.image_dir) if name.endswith('.part')], [])
+
+    def test_failed_background_write_reported_by_close(self):
+        config = ExtractorConfig(output_dir=self.tmp.name, image_encode_workers=1)
+        buffer = BytesIO()
+        Image.effect_noise((300, 300), 50).convert('RGB').save(buffer, 'PNG')
+        truncated = buffer.getvalue()[:2000] # The header parses, the pixel data does not
+        processor = ImageProcessor(self.image_dir, LOGGER)
+        details = processor.save(truncated, 'test', config=config)
+        self.assertEqual(processor.close(), [details['filename']])
+        self.assertFalse(Path(details['filepath']).exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
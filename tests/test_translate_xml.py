@@ -0,0 +1,113 @@
+import asyncio
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+
+import translate_xml
+from translate_xml import RateLimiter, XMLTranslator
+
+LONG_A = 'The first paragraph is long enough for the text cache.'
+LONG_B = 'The second paragraph is also long enough to be cached.'
+
+
+def timed_acquires(limiter, estimated_tokens=0, count=1):
+    async def acquire_all():
+        for _ in range(count):
+            await limiter.acquire(estimated_tokens)
+    start = time.monotonic()
+    asyncio.run(acquire_all())
+    return time.monotonic() - start
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_full_bucket_does_not_wait(self):
+        self.assertLess(timed_acquires(RateLimiter(60), count=60), 0.05)
+
+    def test_empty_bucket_waits_for_one_request(self):
+        limiter = RateLimiter(600) # One request every 0.1 s
+        limiter.available_request_capacity = 0
+        self.assertGreaterEqual(timed_acquires(limiter), 0.09)
+
+    def test_token_budget_waits(self):
+        limiter = RateLimiter(None, 60000) # 1000 tokens/s
+        limiter.available_token_capacity = 0
+        self.assertGreaterEqual(timed_acquires(limiter, estimated_tokens=100), 0.09)
+
+    def test_no_request_limit(self):
+        for requests_per_minute in (None, 0):
+            with self.subTest(requests_per_minute=requests_per_minute):
+                self.assertLess(timed_acquires(RateLimiter(requests_per_minute), count=1000), 0.5)
+
+    def test_penalize_halves_the_rate(self):
+        limiter = RateLimiter(600)
+        limiter.penalize()
+        self.assertEqual(limiter.slowdown, 0.5)
+        self.assertGreaterEqual(timed_acquires(limiter), 0.19)
+
+
+@mock.patch.object(translate_xml, 'API_KEY', 'test-key')
+class TextCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def translator(self, name):
+        with contextlib.redirect_stdout(io.StringIO()):
+            translator = XMLTranslator(os.path.join(self.tmp.name, name))
+        self.addCleanup(translator.close_text_cache)
+        return translator
+
+    def deduplicate(self, translator, texts):
+        elements = [{'id': f"p{i}", 'text': text, 'type': 'paragraph'} for i, text in enumerate(texts, start=1)]
+        translator.elements_to_translate = elements
+        with contextlib.redirect_stdout(io.StringIO()):
+            return [elem['id'] for elem in translator.deduplicate(elements)]
+
+    def test_repeated_text_sent_once(self):
+        translator = self.translator('book.xml')
+        pending = self.deduplicate(translator, [LONG_A, 'Short.', LONG_A, 'Short.', LONG_B])
+        # Short repeats stay in context; the long repeat copies the first occurrence's translation
+        self.assertEqual(pending, ['p1', 'p2', 'p4', 'p5'])
+        self.assertEqual(translator.duplicate_ids['p1'], ['p3'])
+        translator._add_translations([('p1', 'VI A')])
+        self.assertEqual(translator.translation_cache['p3'], 'VI A')
+
+    def test_text_cache_round_trip(self):
+        first = self.translator('book1.xml')
+        self.deduplicate(first, [LONG_A, LONG_B])
+        first._add_translations([('p1', 'VI A'), ('p2', 'VI B')])
+        first.save_progress()
+        first.close_text_cache()
+        self.assertFalse(os.path.exists(first.text_cache_file + '-wal'))
+        with sqlite3.connect(first.text_cache_file) as db:
+            self.assertEqual(db.execute("SELECT COUNT(*) FROM translations").fetchone()[0], 2)
+
+        # Another XML file in the same folder reuses the translations without sending them
+        second = self.translator('book2.xml')
+        pending = self.deduplicate(second, ['Short.', LONG_B])
+        self.assertEqual(pending, ['p1'])
+        self.assertEqual(second.translation_cache['p2'], 'VI B')
+
+    def test_text_cache_is_per_model(self):
+        first = self.translator('book1.xml')
+        self.deduplicate(first, [LONG_A])
+        first._add_translations([('p1', 'VI A')])
+        first.save_progress()
+        first.close_text_cache()
+
+        with mock.patch.object(translate_xml, 'API_MODEL', 'another/model'):
+            second = self.translator('book2.xml')
+            self.assertEqual(self.deduplicate(second, [LONG_A]), ['p1'])
+
+
+if __name__ == '__main__':
+    unittest.main()